@@ -0,0 +1,406 @@
+import argparse
+import asyncio
+import csv
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../model_prep/src"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../python-nopu"))
+import data_loader
+
+# benchmark harness for all platforms the network runs on. A backend classifies a block of images (N x 32 x 32 x 3
+# uint8); the harness feeds it the test set in blocks of batch_size images for a number of rounds, after a few
+# warm-up images, and records every image in a preallocated structured array of RESULT_DTYPE. Every backend imports
+# its dependencies only when it is used, so e.g. the Edge TPU runs without tensorflow. Examples:
+#   python bench.py tflite -n 1000
+#   python bench.py tflite --threads 1 4 --batch_sizes 1 8 64 256
+#   python bench.py fpga --target 127.0.0.2 --host 127.0.0.1 -r 3
+# time_gross includes handing the block to the backend (e.g. copying it into the input tensor), time_net is the
+# inference alone. Both are in nanoseconds and taken for the whole block, i.e. they are the latency every image of
+# the block sees. With several thread counts or batch sizes, every combination is run and summarized as a point of
+# a throughput/latency curve of CURVE_DTYPE
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+KERAS_MODEL = os.path.join(HERE, "../model_prep/models/model.pt")
+TFLITE_MODEL = os.path.join(HERE, "../model_prep/models/8x32_model_qat.tflite")
+EDGETPU_MODEL = os.path.join(HERE, "model/8x32_model_qat.tflite")
+RESULTS_DIR = os.path.join(HERE, "results")
+NUM_ROUNDS = 1
+NUM_IMGS = 10000
+NUM_WARMUP = 10
+# batch sizes swept by cpu_benchmark.py
+BATCH_SWEEP = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+RESULT_DTYPE = np.dtype(
+    [
+        ("backend", "U8"),
+        ("threads", np.int16),
+        ("batch_size", np.int32),
+        ("round", np.int32),
+        ("img_id", np.int32),
+        ("label", np.int16),
+        ("prediction", np.int16),
+        ("time_gross", np.int64),
+        ("time_net", np.int64),
+    ]
+)
+# one point per configuration. Throughput from time_gross, latency percentiles of whole blocks
+CURVE_DTYPE = np.dtype(
+    [
+        ("backend", "U8"),
+        ("threads", np.int16),
+        ("batch_size", np.int32),
+        ("images", np.int32),
+        ("accuracy", np.float64),
+        ("throughput", np.float64),
+        ("latency_mean", np.int64),
+        ("latency_p50", np.int64),
+        ("latency_p99", np.int64),
+    ]
+)
+
+
+def parse_args(argv=None, backend=None, **defaults):
+    # backend and defaults are the defaults of the wrapper scripts, which then take the same options without naming
+    # a backend
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "backend",
+        nargs="?" if backend else None,
+        default=backend,
+        choices=sorted(BACKENDS),
+        help="platform to benchmark",
+    )
+    parser.add_argument("-r", "--rounds", type=int, default=NUM_ROUNDS, help="passes over the images")
+    parser.add_argument("-n", "--num_images", type=int, default=NUM_IMGS, help="test images per round")
+    parser.add_argument("-w", "--warmup", type=int, default=NUM_WARMUP, help="images classified before timing")
+    parser.add_argument(
+        "-b",
+        "--batch_sizes",
+        type=int,
+        nargs="+",
+        default=[1],
+        help="images per block, several for a sweep",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        nargs="+",
+        default=[0],
+        help="tflite: interpreter threads, several for a sweep. 0 for the interpreter's default",
+    )
+    parser.add_argument("-m", "--model", help="model file. Default: the one of the backend")
+    parser.add_argument(
+        "-o",
+        "--output",
+        help=".csv or .npy file to write the results to. Default: results/<backend>_benchmark.csv",
+    )
+    parser.add_argument(
+        "--curve",
+        help=".csv or .npy file to write the throughput/latency curve to. Default: results/<backend>_curve.csv",
+    )
+    parser.add_argument("--target", default=None, help="fpga: address of the board, e.g. of fake_board.py")
+    parser.add_argument("--host", default=None, help="fpga: local address to bind to")
+    parser.set_defaults(**defaults)
+
+    return vars(parser.parse_args(argv))
+
+
+# keras model, called eagerly like model(x) in training code
+class KerasBackend:
+    def __init__(self, model=None):
+        import tensorflow as tf
+
+        self.model = tf.keras.models.load_model(model or KERAS_MODEL)
+        self.x = None
+
+    def set_input(self, imgs):
+        self.x = imgs
+
+    def infer(self):
+        return np.argmax(self.model(self.x), axis=-1)
+
+    def close(self):
+        pass
+
+
+# quantized model on the TFLite interpreter, from tflite_runtime if installed and from tensorflow otherwise. The
+# model takes uint8 pixels as they are. threads is passed to the interpreter, None or 0 leaves its default
+class TfliteBackend:
+    def __init__(self, model=None, threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+
+            Interpreter = tf.lite.Interpreter
+
+        self.interpreter = Interpreter(model_path=model or TFLITE_MODEL, num_threads=threads or None)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+
+        if self.input["dtype"] != np.uint8:
+            raise ValueError("model must be uint8 quantized")
+
+    def set_input(self, imgs):
+        # resize the input tensor if the block size changes
+        if tuple(self.input["shape"]) != imgs.shape:
+            self.interpreter.resize_tensor_input(self.input["index"], imgs.shape)
+            self.interpreter.allocate_tensors()
+            self.input = self.interpreter.get_input_details()[0]
+            self.output = self.interpreter.get_output_details()[0]
+        self.interpreter.set_tensor(self.input["index"], imgs)
+
+    def infer(self):
+        self.interpreter.invoke()
+        return np.argmax(self.interpreter.get_tensor(self.output["index"]), axis=-1)
+
+    def close(self):
+        pass
+
+
+# compiled model on a Coral Edge TPU through pycoral. Single images only
+class EdgeTpuBackend:
+    def __init__(self, model=None):
+        from pycoral.adapters import classify, common
+        from pycoral.utils.edgetpu import make_interpreter
+
+        self.classify = classify
+        self.common = common
+        self.interpreter = make_interpreter(model or EDGETPU_MODEL)
+        self.interpreter.allocate_tensors()
+
+        if common.input_details(self.interpreter, "dtype") != np.uint8:
+            raise ValueError("model must be uint8 quantized")
+
+    def set_input(self, imgs):
+        if len(imgs) != 1:
+            raise ValueError("the Edge TPU backend takes one image at a time")
+        self.common.set_input(self.interpreter, imgs[0])
+
+    def infer(self):
+        self.interpreter.invoke()
+        return np.array([self.classify.get_classes(self.interpreter, 1, 0)[0].id])
+
+    def close(self):
+        pass
+
+
+# the accelerator, through the asyncio client of python-nopu on a private event loop. The images of a block are in
+# flight together, so the board overlaps their transfer with compute. Images that fail are predicted as -1
+class FpgaBackend:
+    def __init__(self, model=None, target=None, host=None):
+        from async_client import open_client
+        from protocol import HOST_IP, PORT, TARGET_IP, InferenceError
+
+        self.error = InferenceError
+        self.loop = asyncio.new_event_loop()
+        self.client = self.loop.run_until_complete(
+            open_client((host or HOST_IP, PORT), target=(target or TARGET_IP, PORT))
+        )
+        self.imgs = None
+
+    def set_input(self, imgs):
+        self.imgs = imgs
+
+    async def infer_all(self):
+        return await asyncio.gather(*[self.client.infer(img) for img in self.imgs], return_exceptions=True)
+
+    def infer(self):
+        res = self.loop.run_until_complete(self.infer_all())
+        for r in res:
+            if not isinstance(r, (int, self.error)):
+                raise r
+        return np.array([-1 if isinstance(r, self.error) else r for r in res])
+
+    def close(self):
+        self.client.close()
+        self.loop.run_until_complete(self.client.closed)
+        self.loop.close()
+
+
+# the simulator in fixed-point mode, which is bit-exact with the accelerator
+class SimulatorBackend:
+    def __init__(self, model=None):
+        import simulator
+        import tensorflow as tf
+
+        interpreter = tf.lite.Interpreter(model_path=model or TFLITE_MODEL)
+        interpreter.allocate_tensors()
+        self.simulator = simulator
+        self.plan = simulator.build_plan(interpreter)
+        self.arena = simulator.init_arena(self.plan, 1, fixed_point=True)
+        self.x = None
+
+    def set_input(self, imgs):
+        if len(imgs) > self.arena["batch_size"]:
+            self.arena = self.simulator.init_arena(self.plan, len(imgs), fixed_point=True)
+        self.x = imgs
+
+    def infer(self):
+        return self.simulator.predict(self.simulator.run_plan(self.plan, self.x, self.arena))
+
+    def close(self):
+        pass
+
+
+BACKENDS = {
+    "keras": KerasBackend,
+    "tflite": TfliteBackend,
+    "edgetpu": EdgeTpuBackend,
+    "fpga": FpgaBackend,
+    "sim": SimulatorBackend,
+}
+
+
+def open_backend(args, threads=0):
+    cls = BACKENDS[args["backend"]]
+    if cls is FpgaBackend:
+        return cls(args["model"], args["target"], args["host"])
+    if cls is TfliteBackend:
+        return cls(args["model"], threads)
+    return cls(args["model"])
+
+
+def init_results(name, rounds, labels, batch_size=1, threads=0):
+    # rows for every image of every round, filled in up to the predictions and times. Rounds are cut to whole
+    # blocks, so that the backend sees a single block size
+    num = len(labels) // batch_size * batch_size
+    if num == 0:
+        raise ValueError(f"blocks of {batch_size} images need at least as many images, got {len(labels)}")
+    results = np.zeros(rounds * num, dtype=RESULT_DTYPE)
+    results["backend"] = name
+    results["threads"] = threads
+    results["batch_size"] = batch_size
+    results["round"] = np.repeat(np.arange(rounds), num)
+    results["img_id"] = np.tile(np.arange(num), rounds)
+    results["label"] = np.tile(labels[:num], rounds)
+    return results
+
+
+def run(backend, images, results, warmup=NUM_WARMUP):
+    # classify the images of the rows of results block by block, timing each block. Blocks of the first warmup
+    # images are classified beforehand and not recorded, so lazy initialization, resizing of input tensors and cold
+    # caches don't show up in the times
+    batch_size = int(results["batch_size"][0])
+    for start in range(0, min(warmup, len(images)), batch_size):
+        backend.set_input(images[start : start + batch_size])
+        backend.infer()
+
+    # plain arrays instead of fields in the loop. The rows of a block are consecutive images of a round
+    img_ids = results["img_id"]
+    predictions = results["prediction"]
+    gross = results["time_gross"]
+    net = results["time_net"]
+
+    for start in range(0, len(results), batch_size):
+        stop = start + batch_size
+        i = img_ids[start]
+        t0 = time.perf_counter_ns()
+        backend.set_input(images[i : i + batch_size])
+        t1 = time.perf_counter_ns()
+        prediction = backend.infer()
+        t2 = time.perf_counter_ns()
+
+        predictions[start:stop] = prediction
+        gross[start:stop] = t2 - t0
+        net[start:stop] = t2 - t1
+
+    return results
+
+
+def curve_point(results):
+    # throughput and block latency of a run with a single configuration
+    point = np.zeros((), dtype=CURVE_DTYPE)
+    for name in ["backend", "threads", "batch_size"]:
+        point[name] = results[name][0]
+
+    # every block shows up once per image
+    blocks = results["time_gross"][:: int(results["batch_size"][0])]
+    point["images"] = len(results)
+    point["accuracy"] = np.mean(results["prediction"] == results["label"])
+    point["throughput"] = 1e9 * len(results) / blocks.sum()
+    point["latency_mean"] = blocks.mean()
+    point["latency_p50"] = np.percentile(blocks, 50)
+    point["latency_p99"] = np.percentile(blocks, 99)
+    return point
+
+
+def save_results(results, path):
+    # a structured array as .npy or as CSV with a header row
+    if path.endswith(".npy"):
+        np.save(path, results)
+        return
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(results.dtype.names)
+        writer.writerows(results.tolist())
+
+
+def print_summary(results):
+    accuracy = np.mean(results["prediction"] == results["label"])
+    print(f"{results['backend'][0]}: {len(results)} images, accuracy {accuracy}")
+
+    for name in ["time_net", "time_gross"]:
+        t = results[name] / 1e6
+        print(f"{name} (ms): mean {t.mean():.3f}, p50 {np.percentile(t, 50):.3f}, p99 {np.percentile(t, 99):.3f}")
+    print(f"throughput: {curve_point(results)['throughput']:.1f} images/s")
+
+
+def print_curve(curve):
+    print(f"{'threads':>8}{'batch':>8}{'images/s':>12}{'mean':>10}{'p50':>10}{'p99':>10}  (ms per block)")
+    for p in curve:
+        latencies = [p["latency_mean"], p["latency_p50"], p["latency_p99"]]
+        print(
+            f"{p['threads']:>8}{p['batch_size']:>8}{p['throughput']:>12.1f}"
+            + "".join(f"{t / 1e6:>10.3f}" for t in latencies)
+        )
+
+
+def main(args):
+    images, labels = data_loader.load_cached("cifar")
+    labels = labels[: min(args["num_images"], len(images))].reshape(-1)
+    runs = []
+
+    # a block never holds more than all images
+    batch_sizes = [b for b in args["batch_sizes"] if b <= len(labels)]
+    skipped = sorted(set(args["batch_sizes"]) - set(batch_sizes))
+    if skipped:
+        print(f"skipping batch sizes above {len(labels)} images: {' '.join(map(str, skipped))}")
+    if not batch_sizes:
+        sys.exit("no batch size fits the number of images")
+
+    # an interpreter per thread count, all batch sizes on it
+    for threads in args["threads"]:
+        backend = open_backend(args, threads)
+        try:
+            for batch_size in batch_sizes:
+                results = init_results(args["backend"], args["rounds"], labels, batch_size, threads)
+                runs.append(run(backend, images, results, args["warmup"]))
+        finally:
+            backend.close()
+
+    results = np.concatenate(runs)
+    output = args["output"] or os.path.join(RESULTS_DIR, f"{args['backend']}_benchmark.csv")
+    save_results(results, output)
+
+    if len(runs) == 1:
+        print_summary(results)
+        print(f"results in {output}")
+        return
+
+    curve = np.array([curve_point(r) for r in runs], dtype=CURVE_DTYPE)
+    print_curve(curve)
+    path = args["curve"] or os.path.join(RESULTS_DIR, f"{args['backend']}_curve.csv")
+    save_results(curve, path)
+    print(f"results in {output}, curve in {path}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -1,10 +1,13 @@
 import socket
-import tensorflow as tf
 import numpy as np
 import time
 import sys
+import os
 import pandas as pd
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../model_prep/src"))
+import data_loader
+
 NUM_ROUNDS = 1
 NUM_IMGS = 10000
 
@@ -35,7 +38,7 @@ def inf(img):
 
 def main():
     # load dataset
-    (_, _), (test_images, test_labels) = tf.keras.datasets.cifar10.load_data()
+    test_images, test_labels = data_loader.load_cached("cifar")
     # send images forever to measure power usage
     while True:
         # iterate over the entire dataset
@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import numpy as np
+
+import bench
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../model_prep/src"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../python-nopu"))
+import data_loader
+from async_client import BOARD_DEPTH, open_client
+from latency import init_phases, summary
+from protocol import HOST_IP, PORT, TARGET_IP, InferenceError, init_stats
+
+# open-loop load generator for the accelerator. Requests arrive at a target rate, as a Poisson process or evenly spaced,
+# no matter whether earlier ones are done, and go to the board through the asyncio client. Every request is timed from
+# its scheduled arrival, so the time it waits to be sent (queue) is recorded apart from the time the board takes for it
+# once the image before it is done (service). Rates are swept from START_RATE up by RATE_STEP until the board falls
+# behind, then narrowed down between the last rate it kept up with and the first one it did not. Every rate replays the
+# same Poisson arrivals, only scaled in time, so that the rates differ in nothing but the load and the sweep does not
+# chase noise. Throughput counts the images done while requests arrive, not while the backlog drains. Examples:
+#   python ../python-nopu/fake_board.py --latency 0.028 &
+#   python load_gen.py --target 127.0.0.2 --host 127.0.0.1 -d 5
+#   python load_gen.py --rates 10 20 30 --arrivals constant
+
+# seconds of arrivals per rate
+DURATION = 10
+START_RATE = 5
+RATE_STEP = 1.25
+MAX_RATE = 1000
+# bisections between the last rate sustained and the first one saturated
+REFINE = 3
+# a rate is saturated if, when the arrivals end, more requests than the board holds plus this fraction of all of them
+# are not done yet, or if more than this fraction fails
+SAT_TOLERANCE = 0.05
+NUM_WARMUP = 10
+ARRIVALS = ["poisson", "constant"]
+LATENCY_PHASES = ["queue", "service", "total"]
+
+# one point per rate. offered and throughput are arrivals and images done per second while requests arrive, backlog
+# the requests not done when they end. Latencies in ns, from the histograms of the client
+CURVE_DTYPE = np.dtype(
+    [
+        ("arrivals", "U8"),
+        ("rate", np.float64),
+        ("offered", np.float64),
+        ("throughput", np.float64),
+        ("requests", np.int32),
+        ("failed", np.int32),
+        ("backlog", np.int32),
+        ("retries", np.int32),
+        *[(f"{phase}_{stat}", np.int64) for phase in LATENCY_PHASES for stat in ["mean", "p50", "p99"]],
+        ("saturated", np.bool_),
+    ]
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", default=TARGET_IP, help="address of the board, e.g. of fake_board.py")
+    parser.add_argument("--host", default=HOST_IP, help="local address to bind to")
+    parser.add_argument("-d", "--duration", type=float, default=DURATION, help="seconds of arrivals per rate")
+    parser.add_argument("--arrivals", choices=ARRIVALS, default="poisson", help="arrival process")
+    parser.add_argument("--rates", type=float, nargs="+", help="images per second to offer instead of a sweep")
+    parser.add_argument("--start", type=float, default=START_RATE, help="first rate of the sweep")
+    parser.add_argument("--step", type=float, default=RATE_STEP, help="factor between rates of the sweep")
+    parser.add_argument("--max_rate", type=float, default=MAX_RATE, help="highest rate of the sweep")
+    parser.add_argument(
+        "--refine",
+        type=int,
+        default=REFINE,
+        help="bisections of the range the board saturates in",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed for Poisson arrivals, the same for all rates")
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=os.path.join(bench.RESULTS_DIR, "fpga_load.csv"),
+        help=".csv or .npy file to write the latency/throughput curve to",
+    )
+
+    return vars(parser.parse_args())
+
+
+def arrival_times(rate, duration, arrivals, seed):
+    # seconds from the start at which requests arrive. Poisson arrivals are the arrivals of a process of rate 1 drawn
+    # from seed, scaled to the rate, so a higher rate has the same arrivals and more
+    if arrivals == "constant":
+        return np.arange(int(rate * duration)) / rate
+
+    expected = rate * duration
+    gaps = np.random.default_rng(seed).standard_exponential(int(expected + 10 * np.sqrt(expected) + 10))
+    times = np.cumsum(gaps) / rate
+    return times[times < duration]
+
+
+async def request(client, img, arrival):
+    # result of a request, or its InferenceError, and when it was done in ns
+    try:
+        res = await client.infer(img, t_start=arrival)
+    except InferenceError as e:
+        res = e
+    return res, time.perf_counter_ns()
+
+
+async def offer(client, images, times):
+    # issue a request at every arrival time and wait for all of them. Returns the results, or the errors of failed
+    # requests, and when they were done in ns after the start
+    tasks = []
+    t0 = time.perf_counter_ns()
+
+    for i, t in enumerate(times):
+        arrival = t0 + int(t * 1e9)
+        delay = arrival - time.perf_counter_ns()
+        if delay > 0:
+            await asyncio.sleep(delay / 1e9)
+        tasks.append(asyncio.ensure_future(request(client, images[i % len(images)], arrival)))
+
+    res, done = zip(*await asyncio.gather(*tasks)) if tasks else ((), ())
+    return res, np.array(done, dtype=np.int64) - t0
+
+
+async def measure(client, images, rate, args):
+    # a point of the curve at a rate, with fresh statistics of the client
+    duration = args["duration"]
+    times = arrival_times(rate, duration, args["arrivals"], args["seed"])
+    client.latency = init_phases()
+    client.stats = init_stats()
+    res, done = await offer(client, images, times)
+
+    ok = np.array([not isinstance(r, InferenceError) for r in res], dtype=bool)
+    failed = len(res) - int(ok.sum())
+    in_time = done <= duration * 1e9
+
+    point = np.zeros((), dtype=CURVE_DTYPE)
+    point["arrivals"] = args["arrivals"]
+    point["rate"] = rate
+    point["offered"] = len(times) / duration
+    point["throughput"] = np.count_nonzero(ok & in_time) / duration
+    point["requests"] = len(res)
+    point["failed"] = failed
+    point["backlog"] = np.count_nonzero(~in_time)
+    point["retries"] = client.stats["retries"]
+    for phase in LATENCY_PHASES:
+        s = summary(client.latency[phase])
+        for stat in ["mean", "p50", "p99"]:
+            point[f"{phase}_{stat}"] = s[stat] or 0
+    point["saturated"] = (
+        point["backlog"] > BOARD_DEPTH + SAT_TOLERANCE * len(res) or failed > SAT_TOLERANCE * len(res)
+    )
+
+    print_point(point)
+    return point
+
+
+async def sweep(client, images, args):
+    # points at the given rates, or at rates growing until the board saturates and then bisected
+    if args["rates"]:
+        return [await measure(client, images, rate, args) for rate in args["rates"]]
+
+    points = []
+    sustained = saturated = None
+    rate = args["start"]
+
+    while rate <= args["max_rate"]:
+        points.append(await measure(client, images, rate, args))
+        if points[-1]["saturated"]:
+            saturated = rate
+            break
+        sustained = rate
+        rate *= args["step"]
+
+    if sustained is not None and saturated is not None:
+        for _ in range(args["refine"]):
+            rate = (sustained + saturated) / 2
+            points.append(await measure(client, images, rate, args))
+            if points[-1]["saturated"]:
+                saturated = rate
+            else:
+                sustained = rate
+
+    return sorted(points, key=lambda p: p["rate"])
+
+
+def print_header():
+    phases = "".join(f"{f'{phase} p50':>13}{f'{phase} p99':>13}" for phase in LATENCY_PHASES)
+    print(f"{'rate':>8}{'offered':>9}{'images/s':>10}{'failed':>8}{'backlog':>9}{phases}  (ms)")
+
+
+def print_point(p):
+    latencies = [p[f"{phase}_{stat}"] for phase in LATENCY_PHASES for stat in ["p50", "p99"]]
+    print(
+        f"{p['rate']:>8.1f}{p['offered']:>9.1f}{p['throughput']:>10.1f}{p['failed']:>8}{p['backlog']:>9}"
+        + "".join(f"{t / 1e6:>13.3f}" for t in latencies)
+        + ("  saturated" if p["saturated"] else "")
+    )
+
+
+def print_saturation(curve):
+    # the highest rate the board kept up with and the most it classified at any rate
+    sustained = curve[~curve["saturated"]]
+    if len(sustained) == 0:
+        print("saturated at every rate")
+    else:
+        best = sustained[np.argmax(sustained["rate"])]
+        print(
+            f"sustained up to {best['offered']:.1f} images/s offered (rate {best['rate']:.1f}), "
+            f"p99 latency {best['total_p99'] / 1e6:.2f} ms of which {best['queue_p99'] / 1e6:.2f} ms queueing"
+        )
+    if curve["saturated"].any():
+        print(f"saturation point: {curve['throughput'].max():.1f} images/s")
+
+
+async def main(args):
+    images, _ = data_loader.load_cached("cifar")
+
+    async with await open_client((args["host"], PORT), target=(args["target"], PORT)) as client:
+        # closed-loop requests first, so the retry timeouts fit the board before the first rate
+        await asyncio.gather(*[client.infer(images[i]) for i in range(NUM_WARMUP)])
+        print_header()
+        curve = np.array(await sweep(client, images, args), dtype=CURVE_DTYPE)
+
+    print_saturation(curve)
+    bench.save_results(curve, args["output"])
+    print(f"curve in {args['output']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
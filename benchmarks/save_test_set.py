@@ -1,35 +1,21 @@
 """
 The point of this small script is to remove tensorflow from the list of dependencies when running the
 tpu benchmark as I had trouble getting both tensorflow and pycoral running on some versions of python.
+Run it once where tensorflow is installed. It fills the shared dataset cache of model_prep/src/data_loader.py,
+which the benchmarks then read without tensorflow.
 """
 
-import tensorflow as tf
-import numpy as np
+import os
+import sys
 
-LABEL_PATH = 'test_data/labels.txt'
-IMAGE_PATH = 'test_data/images.npy'
-W = 32
-C = 3
-
-def save_labels(test_labels):
-    label_file = open(LABEL_PATH, 'w')
-    for label_list in test_labels:
-        label_file.writelines(str(label_list[0]) + '\n')
-    label_file.close()
-
-def save_images(test_images):
-    data = np.zeros((len(test_images), W, W, C))
-    for img_id in range(len(test_images)):
-        data[img_id] = test_images[img_id]
-        
-    with open(IMAGE_PATH, 'wb') as image_file:
-        np.save(image_file, data)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../model_prep/src"))
+import data_loader
 
 def main():
-    (_, _), (test_images, test_labels) = tf.keras.datasets.cifar10.load_data()
-    save_labels(test_labels)
-    save_images(test_images)
+    data_loader.build_cache("cifar")
+    test_images, test_labels = data_loader.load_cached("cifar")
+    print(f"cached {len(test_images)} test images in {data_loader.CACHE_PATH}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
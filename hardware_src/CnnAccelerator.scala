@@ -27,6 +27,21 @@ class CnnAccelerator() extends CoprocessorMemoryAccess() {
     bram.io.rdAddr := 0.U
     val layer_offset = scala.math.pow(2,14).toInt.U
 
+    // image buffer: two banks of 2^IMG_BANK_BITS pixels. FUNC_LOAD_IMG writes to load_bank while the network reads
+    // its input from run_bank, so the next image can be loaded during an inference. FUNC_RUN swaps the banks
+    val img_bram = Module(new BramControl(IMG_BANK_BITS + 1, PX_WIDTH))
+    img_bram.io.wrEna := false.B
+    img_bram.io.wrAddr := 0.U
+    img_bram.io.wrData := 0.S
+    img_bram.io.rdAddr := 0.U
+    val load_bank = RegInit(0.U(1.W))
+    val run_bank = RegInit(0.U(1.W))
+
+    // layer 0 reads its input (the lower half of BRAM) from the image buffer instead. The read data arrives a cycle
+    // after the address, and so does the select
+    val img_rd = RegInit(false.B)
+    val bram_rd_data = Mux(img_rd, img_bram.io.rdData.pad(DATA_WIDTH), bram.io.rdData)
+
     // auxiliary registers
     val addrReg = RegInit(0.U(DATA_WIDTH.W))
     val resReg = RegInit(10.U(DATA_WIDTH.W))
@@ -36,7 +51,6 @@ class CnnAccelerator() extends CoprocessorMemoryAccess() {
     val maxOut = RegInit(0.U(DATA_WIDTH.W))
     val outAddr = RegInit(0.U(DATA_WIDTH.W))
     val layer = RegInit(0.U(8.W))
-    val img_val = RegInit(0.U(DATA_WIDTH.W))
     
     val outs = Reg(Vec(BURST_LENGTH, SInt(DATA_WIDTH.W)))
     val idx = RegInit(0.U(DATA_WIDTH.W))
@@ -63,7 +77,7 @@ class CnnAccelerator() extends CoprocessorMemoryAccess() {
     val conv_layer = Module(new LayerConv())
     
     // BRAM inputs
-    conv_layer.io.bram_rd_data := bram.io.rdData
+    conv_layer.io.bram_rd_data := bram_rd_data
 
     // SRAM inputs
     conv_layer.io.sram_state := 0.U
@@ -87,7 +101,7 @@ class CnnAccelerator() extends CoprocessorMemoryAccess() {
     val pool_layer = Module(new LayerMaxPool())
     
     // BRAM inputs
-    pool_layer.io.bram_rd_data := bram.io.rdData
+    pool_layer.io.bram_rd_data := bram_rd_data
 
     // SRAM inputs
     pool_layer.io.sram_state := 0.U
@@ -111,7 +125,7 @@ class CnnAccelerator() extends CoprocessorMemoryAccess() {
     val fc_layer = Module(new LayerFc())
 
     // BRAM inputs
-    fc_layer.io.bram_rd_data := bram.io.rdData
+    fc_layer.io.bram_rd_data := bram_rd_data
 
     // SRAM inputs
     fc_layer.io.sram_state := 0.U
@@ -174,6 +188,10 @@ class CnnAccelerator() extends CoprocessorMemoryAccess() {
         bram.io.rdAddr := fc_layer.io.bram_rd_addr
     }
 
+    img_bram.io.rdAddr := Cat(run_bank, bram.io.rdAddr(IMG_BANK_BITS - 1, 0))
+    val in_layer = stateReg === conv || stateReg === pool || stateReg === fc
+    img_rd := in_layer && layer === 0.U && bram.io.rdAddr < layer_offset
+
     when (conv_layer.io.bram_wr_req) {
         bram.io.wrEna := true.B
         bram.io.wrAddr := conv_layer.io.bram_wr_addr
@@ -223,6 +241,8 @@ class CnnAccelerator() extends CoprocessorMemoryAccess() {
                 }
                 is(FUNC_RUN) {
                     when(isIdle) {
+                        run_bank := load_bank               // classify the image loaded last
+                        load_bank := ~load_bank             // and load the next one into the other bank
                         stateReg := start
                     }
                 }
@@ -235,11 +255,10 @@ class CnnAccelerator() extends CoprocessorMemoryAccess() {
                     }
                 }
                 is(FUNC_LOAD_IMG) {
-                    when(isIdle) {
-                        addrReg := io.copIn.opData(0).asUInt
-                        img_val := io.copIn.opData(1)
-                        stateReg := mem_wr
-                    }
+                    // accepted while busy, the bank being loaded is not read by the inference
+                    img_bram.io.wrEna := true.B
+                    img_bram.io.wrAddr := Cat(load_bank, io.copIn.opData(0)(IMG_BANK_BITS - 1, 0))
+                    img_bram.io.wrData := io.copIn.opData(1)(7, 0).zext
                 }
                 is(FUNC_MEM_R) {
                     when(isIdle) {
@@ -293,7 +312,8 @@ class CnnAccelerator() extends CoprocessorMemoryAccess() {
         }
         is(start) {
             /*
-            Prepare for inference. Assumes that model and image are in the defined memory locations.
+            Prepare for inference. Assumes that model and image are in the defined memory locations (the image in the
+            bank just swapped in by FUNC_RUN).
             If that is not the case by this state, the inference will go horribly wrong.
             */
             layer := 0.U                                    // reset layer count
@@ -302,16 +322,6 @@ class CnnAccelerator() extends CoprocessorMemoryAccess() {
             outAddr := 0.U
             stateReg := next_layer
         }
-        is(mem_wr) {
-            /*
-            write image into bram
-            */
-            bram.io.wrEna := true.B
-            bram.io.wrAddr := addrReg
-            bram.io.wrData := img_val.asSInt
-
-            stateReg := idle
-        }
         is(mem_addr_set) {
             bram.io.rdAddr := addrReg
             stateReg := mem_r
@@ -522,6 +532,8 @@ class CnnAccelerator() extends CoprocessorMemoryAccess() {
             addrReg := 0.U
 
             resReg := 10.U
+            load_bank := 0.U
+            run_bank := 0.U
             mem_r_buffer := Seq(0.U, 0.U, 0.U, 0.U)
             mem_w_buffer := Seq(0.U, 0.U, 0.U, 0.U)
 
@@ -2,12 +2,10 @@ package cnnacc
 
 import chisel3._
 
-class BramControl() extends Module {
+class BramControl(size: Int = 15, dataWidth: Int = 32) extends Module {
     /*
-    BRAM memory entity
+    BRAM memory entity with 2^size words of dataWidth bits
     */
-    val size = 15
-    val dataWidth = 32
 
     val io = IO(new Bundle {
         val rdAddr = Input(UInt (size.W))
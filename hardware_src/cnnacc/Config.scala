@@ -8,9 +8,11 @@ object Config {
     val MAX_CONVOLUTIONS = 32
     val ABS_MIN = -2147483646
     val IMG_CHUNK_SIZE = 3072.U
+    val IMG_BANK_BITS = 12                  // words per image buffer bank: 2^12 >= 3072
+    val PX_WIDTH = 9                        // pixels 0..255 as SInt
     
     // states COP control
-    val idle :: start :: fc :: conv :: pool :: mem_r :: mem_wr :: mem_addr_set :: restart :: reset_memory :: reset_memory_aux :: next_layer :: layer_done :: read_output :: find_max :: save_max :: clear_layer :: set_offset :: config :: Nil = Enum(19)
+    val idle :: start :: fc :: conv :: pool :: mem_r :: mem_addr_set :: restart :: reset_memory :: reset_memory_aux :: next_layer :: layer_done :: read_output :: find_max :: save_max :: clear_layer :: set_offset :: config :: Nil = Enum(18)
     // states FC layer
     val fc_idle :: fc_done :: fc_init :: fc_load_input :: fc_load_weight :: fc_load_output :: fc_mac :: fc_write_output :: fc_load_bias :: fc_add_bias :: fc_apply_relu :: fc_write_bias :: fc_requantize :: fc_load_m :: Nil = Enum(14)
     // states CONV layer
@@ -27,6 +29,6 @@ object Config {
     val FUNC_GET_RES          = "b00100".U(5.W)   // read result register
 
     val FUNC_CONFIG           = "b00011".U(5.W)   // receive a network configuration
-    val FUNC_LOAD_IMG         = "b00110".U(5.W)   // write img pixel to BRAM
+    val FUNC_LOAD_IMG         = "b00110".U(5.W)   // write img pixel to the image buffer bank not being classified
     val FUNC_MEM_R            = "b00101".U(5.W)   // TEST: read a value from memory
 }
\ No newline at end of file
@@ -14,6 +14,17 @@ void cop_busy_wait()
     //printf("state: %lu\n", state);
 }
 
+uint32_t cop_poll()
+{
+    // state of the coprocessor, 0 when idle. Does not wait
+    register uint32_t state __asm__("18") = 1;
+    asm(".word 0x3640083" // unpredicated COP_READ to COP0 with FUNC = 00001, RA = 00000, RD = 10010
+        : "=r"(state)
+        :
+        : "18");
+    return state;
+}
+
 void cop_reset()
 {
     asm(".word 0x3400001"); // unpredicated COP_WRITE to COP0 with FUNC = 00000, RA = 00000, RB = 00000
@@ -21,9 +32,16 @@ void cop_reset()
 
 }
 
-void cop_run()
+void cop_start()
 {
+    // start an inference on the image loaded last and return right away. Images sent from now on go to the other
+    // image buffer bank, so the next image can be loaded while this one is classified
     asm(".word 0x3440001"); // unpredicated COP_WRITE to COP0 with FUNC = 00010, RA = 00000, RB = 00000
+}
+
+void cop_run()
+{
+    cop_start();
     cop_busy_wait();
 }
 
@@ -44,8 +62,9 @@ int32_t cop_get_res()
     return result;
 }
 
-void cop_send_px(int addr, int val)
+void cop_send_px_nowait(int addr, int val)
 {
+    // write a pixel into the image buffer bank that is not being classified. Safe during an inference
     register uint32_t addrReg __asm__("16") = addr;
     register uint32_t valReg __asm__("17") = val;
 
@@ -58,7 +77,11 @@ void cop_send_px(int addr, int val)
     // regA     10000
     // regB     10001
     // post     0000001
+}
 
+void cop_send_px(int addr, int val)
+{
+    cop_send_px_nowait(addr, val);
     cop_busy_wait();
 }
 
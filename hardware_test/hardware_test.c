@@ -19,6 +19,26 @@
 
 unsigned int PCKG_SIZE = 1024;
 const uint8_t NUM_BATS = 3;
+// windowed transfer: every chunk starts with a {SEQ, BAT} header, chunks are acknowledged with {SEQ, BAT, MASK}
+const uint8_t HEADER_SIZE = 2;
+const uint8_t ALL_BATS = (1 << 3) - 1;
+// batch transfer: the host declares K images in the header of every chunk, {SEQ, K, IMG, BAT}. Chunks are
+// acknowledged with {SEQ, IMG, BAT, MASK} where MASK is the chunk mask of image IMG. Once all K images are in, they
+// are classified back to back and answered with a single {SEQ, BATCH_RES, K, classes[K], cycles[K]}. The cycle
+// counts are 32 bit big endian and only sent if the host sets BATCH_CYCLES in K
+#define MAX_BATCH_IMGS 64
+const uint8_t BATCH_HEADER_SIZE = 4;
+const uint8_t BATCH_RES = 0xff;
+const uint8_t BATCH_CYCLES = 0x80;
+// pipelining: a windowed image is classified while the next one is received into the other image buffer bank. The
+// accelerator is polled between packets, at least every POLL_TIMEOUT us, and its result sent as soon as it is done
+const unsigned long long POLL_TIMEOUT = 100;
+// results kept to be sent again if the host lost them, one for every image the host has on the board at once
+#define NUM_RES 2
+// a host starts a session with a single {RESET} byte, answered with {RESET}. Results are kept by SEQ only and every
+// host counts SEQs from the start, so results of the previous session must not answer the requests of the next one
+const uint8_t RESET = 0xff;
+const uint8_t RESET_SIZE = 1;
 
 unsigned int UDP_PORT = 5005;
 unsigned int rx_addr = 0x000;
@@ -27,6 +47,22 @@ int32_t img[3072];
 unsigned char HOST_IP[4];	
 uint8_t SEQ = 0;
 uint8_t BAT = 0;
+uint8_t BAT_MASK = 0;           // chunks of the current image received in windowed mode
+bool windowed = false;          // the current image arrived in windowed mode
+bool res_valid[NUM_RES];        // the last windowed images (or batch) are done and their results can be sent again
+uint8_t res_seq[NUM_RES];       // SEQ of those images
+int last_res[NUM_RES];
+uint8_t res_idx = 0;            // slot of the latest result
+bool busy = false;              // an inference runs on the accelerator
+bool busy_windowed = false;     // for an image received in windowed mode
+uint8_t busy_seq = 0;           // with this SEQ
+uint8_t batch_size = 0;         // images in the current batch, 0 outside of batch mode
+bool batch_cycles = false;      // the host asked for cycle counts
+uint8_t batch_done = 0;         // images of the current batch received completely
+uint8_t batch_masks[MAX_BATCH_IMGS];
+uint8_t batch_px[MAX_BATCH_IMGS][3072];
+uint8_t batch_res[MAX_BATCH_IMGS];
+uint32_t batch_cnt[MAX_BATCH_IMGS];
 
 
 
@@ -41,9 +77,9 @@ void print_general_info(){
 	return;
 }
 
-void send_res(int res) {
+void send_res(uint8_t seq, int res) {
     unsigned char buffer[2];
-    unsigned char msg[] = {SEQ, res};
+    unsigned char msg[] = {seq, res};
     udp_t packet;
     packet.data = buffer;
 
@@ -64,19 +100,269 @@ void send_ack() {
     return;
 }
 
+void send_sack(uint8_t seq, uint8_t bat, uint8_t mask) {
+    unsigned char buffer[3];
+    unsigned char msg[] = {seq, bat, mask};
+    udp_t packet;
+    packet.data = buffer;
+    udp_build_packet(&packet, my_ip, HOST_IP, UDP_PORT, UDP_PORT, msg, 3);
+    udp_send_packet(tx_addr, rx_addr, packet, 100000);
+    return;
+}
+
+void send_batch_sack(uint8_t img_idx, uint8_t bat) {
+    unsigned char buffer[4];
+    unsigned char msg[] = {SEQ, img_idx, bat, batch_masks[img_idx]};
+    udp_t packet;
+    packet.data = buffer;
+    udp_build_packet(&packet, my_ip, HOST_IP, UDP_PORT, UDP_PORT, msg, 4);
+    udp_send_packet(tx_addr, rx_addr, packet, 100000);
+    return;
+}
+
+void send_batch_res() {
+    unsigned char buffer[3 + 5 * MAX_BATCH_IMGS];
+    unsigned char msg[3 + 5 * MAX_BATCH_IMGS];
+    unsigned int len = 3 + batch_size;
+    udp_t packet;
+    packet.data = buffer;
+
+    msg[0] = SEQ;
+    msg[1] = BATCH_RES;
+    msg[2] = batch_size | (batch_cycles ? BATCH_CYCLES : 0);
+    for (int i = 0; i < batch_size; i++) {
+        msg[3 + i] = batch_res[i];
+    }
+    if (batch_cycles) {
+        for (int i = 0; i < batch_size; i++) {
+            for (int b = 0; b < 4; b++) {
+                msg[len + 4 * i + b] = batch_cnt[i] >> (24 - 8 * b);
+            }
+        }
+        len += 4 * batch_size;
+    }
+
+    udp_build_packet(&packet, my_ip, HOST_IP, UDP_PORT, UDP_PORT, msg, len);
+    udp_send_packet(tx_addr, rx_addr, packet, 100000);
+    return;
+}
+
+int find_res(uint8_t seq) {
+    // slot of the result kept for seq, or -1
+    for (int i = 0; i < NUM_RES; i++) {
+        if (res_valid[i] && res_seq[i] == seq) {
+            return i;
+        }
+    }
+    return -1;
+}
+
+void save_res(uint8_t seq, int res, bool valid) {
+    // keep a result in place of the oldest one
+    res_idx = (res_idx + 1) % NUM_RES;
+    res_seq[res_idx] = seq;
+    last_res[res_idx] = res;
+    res_valid[res_idx] = valid;
+}
+
+void send_reset_ack() {
+    unsigned char buffer[1];
+    unsigned char msg[] = {RESET};
+    udp_t packet;
+    packet.data = buffer;
+    udp_build_packet(&packet, my_ip, HOST_IP, UDP_PORT, UDP_PORT, msg, 1);
+    udp_send_packet(tx_addr, rx_addr, packet, 100000);
+    return;
+}
+
+void reset_session() {
+    // forget the results and the inference of the previous session, then acknowledge the reset
+    if (busy) {
+        cop_busy_wait();
+        cop_get_res();
+        busy = false;
+    }
+    memset(res_valid, 0, sizeof(res_valid));
+    memset(batch_masks, 0, sizeof(batch_masks));
+    SEQ = 0;
+    BAT = 0;
+    BAT_MASK = 0;
+    windowed = false;
+    batch_size = 0;
+    batch_done = 0;
+    send_reset_ack();
+}
+
+void send_last_res(int i) {
+    // repeat the result of an image or of the last batch, since the host lost it
+    if (batch_size) {
+        send_batch_res();
+    } else {
+        send_res(res_seq[i], last_res[i]);
+    }
+}
+
+bool receive_batch_chunk(unsigned char *udp_data) {
+    /*
+    handle a chunk of a batch. Returns true when all images of the batch are complete. The pixels are kept in main
+    memory, since the accelerator only holds a single image.
+    */
+    uint8_t seq = udp_data[0];
+    uint8_t k = udp_data[1] & ~BATCH_CYCLES;
+    uint8_t img_idx = udp_data[2];
+    uint8_t bat = udp_data[3];
+
+    if (k == 0 || k > MAX_BATCH_IMGS || img_idx >= k || bat >= NUM_BATS) {
+        printf("Invalid chunk.\n");
+        return false;
+    }
+
+    int res = find_res(seq);
+    if (res >= 0) {
+        send_last_res(res);
+        return false;
+    }
+
+    if (!batch_size || seq != SEQ) {
+        memset(batch_masks, 0, sizeof(batch_masks));
+        batch_done = 0;
+    }
+    windowed = true;
+    memset(res_valid, 0, sizeof(res_valid));
+    SEQ = seq;
+    batch_size = k;
+    batch_cycles = udp_data[1] & BATCH_CYCLES;
+
+    if (!(batch_masks[img_idx] & (1 << bat))) {
+        memcpy(&batch_px[img_idx][bat * PCKG_SIZE], &udp_data[BATCH_HEADER_SIZE], PCKG_SIZE);
+        batch_masks[img_idx] |= 1 << bat;
+        if (batch_masks[img_idx] == ALL_BATS) {
+            batch_done++;
+        }
+    }
+    send_batch_sack(img_idx, bat);
+
+    return batch_done == batch_size;
+}
+
+bool receive_chunk(unsigned char *udp_data, unsigned int len) {
+    /*
+    handle a single image chunk. Returns true when the image is complete.
+    stop-and-wait: plain 1024 byte chunks in order, each one acknowledged with {SEQ, BAT}.
+    windowed: chunks with a {SEQ, BAT} header in any order, each one acknowledged with {SEQ, BAT, MASK} where MASK
+    has a bit set for every chunk received so far. The host resends the chunks missing in MASK.
+    Chunks of an image that is already done are answered with its result again, since the host lost it. Chunks of
+    the image being classified are acknowledged as complete.
+    batch: see receive_batch_chunk.
+    A {RESET} byte starts a new session, see reset_session.
+    Pixels go to the image buffer bank not being classified, so this is safe during an inference.
+    */
+    if (len == RESET_SIZE && udp_data[0] == RESET) {
+        reset_session();
+        return false;
+    }
+
+    if (len == PCKG_SIZE + BATCH_HEADER_SIZE) {
+        return receive_batch_chunk(udp_data);
+    }
+
+    if (len == PCKG_SIZE) {
+        windowed = false;
+        memset(res_valid, 0, sizeof(res_valid));
+        batch_size = 0;
+        for (int idx = 0; idx < PCKG_SIZE; idx++) {
+            cop_send_px_nowait(BAT * PCKG_SIZE + idx, udp_data[idx]);
+        }
+        BAT++;
+        send_ack();
+        return BAT == NUM_BATS;
+    }
+
+    if (len != PCKG_SIZE + HEADER_SIZE || udp_data[1] >= NUM_BATS) {
+        printf("Invalid chunk.\n");
+        return false;
+    }
+
+    uint8_t seq = udp_data[0];
+    uint8_t bat = udp_data[1];
+
+    int res = find_res(seq);
+    if (res >= 0) {
+        send_last_res(res);
+        return false;
+    }
+
+    if (busy && seq == busy_seq) {
+        send_sack(seq, bat, ALL_BATS);
+        return false;
+    }
+
+    // a new SEQ starts a new image, even if the host gave up on the previous one
+    if (!windowed || batch_size || seq != SEQ) {
+        BAT_MASK = 0;
+    }
+    // the previous results stay valid while the next image comes in, unless they belong to a batch
+    if (batch_size) {
+        memset(res_valid, 0, sizeof(res_valid));
+    }
+    windowed = true;
+    batch_size = 0;
+    SEQ = seq;
+
+    if (!(BAT_MASK & (1 << bat))) {
+        for (int idx = 0; idx < PCKG_SIZE; idx++) {
+            cop_send_px_nowait(bat * PCKG_SIZE + idx, udp_data[HEADER_SIZE + idx]);
+        }
+        BAT_MASK |= 1 << bat;
+    }
+    send_sack(SEQ, bat, BAT_MASK);
+
+    return BAT_MASK == ALL_BATS;
+}
+
+void finish_inf() {
+    // send the result of the inference that just finished
+    int res = cop_get_res();
+    busy = false;
+    save_res(busy_seq, res, busy_windowed);
+    send_res(busy_seq, res);
+}
+
+void wait_inf() {
+    // wait for the running inference, if any, and send its result
+    if (busy) {
+        cop_busy_wait();
+        finish_inf();
+    }
+}
+
+void start_inf() {
+    // start classifying the image just received and return right away. finish_inf sends the result once it is done
+    cop_start();
+    busy = true;
+    busy_windowed = windowed;
+    busy_seq = SEQ;
+}
+
 void receive_img(){
 	enum eth_protocol packet_type;
 	unsigned char ans;
-	unsigned char udp_data[PCKG_SIZE];
+	unsigned char udp_data[PCKG_SIZE + BATCH_HEADER_SIZE + 1];
+	unsigned int udp_len;
+	bool done = false;
 	unsigned char source_ip[4];	
 	unsigned char destination_ip[4];
 	unsigned short int destination_port;
-	eth_mac_initialize();
-	arp_table_init();
     BAT = 0;
+    BAT_MASK = 0;
 
-	while (BAT<NUM_BATS){
-		eth_mac_receive(rx_addr, 0);
+	while (!done){
+        if (busy && !cop_poll()) {
+            finish_inf();
+        }
+		if (!eth_mac_receive(rx_addr, busy ? POLL_TIMEOUT : 0)) {
+            continue;
+        }
 		packet_type = mac_packet_type(rx_addr);
 		switch (packet_type) {
 		case UNSUPPORTED:
@@ -97,13 +383,14 @@ void receive_img(){
                 }
 				destination_port = udp_get_destination_port(rx_addr);
 				if(destination_port == UDP_PORT){
-                    udp_get_data(rx_addr, udp_data, udp_get_data_length(rx_addr));
-                    udp_data[udp_get_data_length(rx_addr)] = '\0';
-                    for (int idx = 0; idx < PCKG_SIZE; idx++) {
-                        cop_send_px(BAT * PCKG_SIZE + idx, udp_data[idx]);
+                    udp_len = udp_get_data_length(rx_addr);
+                    if (udp_len > PCKG_SIZE + BATCH_HEADER_SIZE) {
+                        printf("Invalid chunk.\n");
+                        break;
                     }
-                    BAT++;
-                    send_ack();
+                    udp_get_data(rx_addr, udp_data, udp_len);
+                    udp_data[udp_len] = '\0';
+                    done = receive_chunk(udp_data, udp_len);
 				}else{
 					printf("Wrong port.\n");
 				}
@@ -119,7 +406,10 @@ void receive_img(){
 	}
 
     BAT = 0;
-    SEQ++;
+    // in windowed mode, SEQ is set by the host
+    if (!windowed) {
+        SEQ++;
+    }
 	return;
 }
 
@@ -130,24 +420,52 @@ void load_img()
     cop_config(0, 7, &img[0]);
 }
 
-int run_inf() {
-    cop_run();
-    return cop_get_res();
+void load_batch_img(int i) {
+    for (int idx = 0; idx < NUM_BATS * PCKG_SIZE; idx++) {
+        cop_send_px_nowait(idx, batch_px[i][idx]);
+    }
+}
+
+void run_batch() {
+    // classify the images of a batch back to back, counting the cycles of each inference. Every image is loaded
+    // while the accelerator classifies the one before
+    load_batch_img(0);
+    for (int i = 0; i < batch_size; i++) {
+        cntReset();
+        cop_start();
+        if (i + 1 < batch_size) {
+            load_batch_img(i + 1);
+        }
+        cop_busy_wait();
+        batch_cnt[i] = cntRead();
+        batch_res[i] = cop_get_res();
+    }
 }
 
 void run_fpga() {
-    int res;
     printf("configuring network...");
     load_nn_cifar_10();
     printf("done\n");
+    eth_mac_initialize();
+    arp_table_init();
     printf("ready to rumble\n");
     
 
     for (;;) {
         receive_img();
-        res = run_inf();
-        send_res(res);
-        //printf("RESULT: %u\n", res);
+        // the accelerator takes one image at a time, the previous one has to finish first
+        wait_inf();
+        if (batch_size) {
+            run_batch();
+            send_batch_res();
+            save_res(SEQ, 0, true);
+            continue;
+        }
+        start_inf();
+        // in stop-and-wait mode, the host sends the next image only after the result
+        if (!windowed) {
+            wait_inf();
+        }
     }
 }
 
@@ -1,38 +1,164 @@
 import argparse
-import sys
+import re
 
-if __name__ == "__main__":
-    args = sys.argv
-    l_id = args[1]
+import numpy as np
+
+# layer dumps are .npz files with the following arrays:
+#   images      indices of the dumped images in the test set, shape (N,)
+#   layer_<i>   flattened activations of layer i in bram order, shape (N, nodes)
+#   offset_<i>  index of the first dumped node of layer i (optional, 0 by default)
+#   shape_<i>   shape of layer i without the batch dimension (optional, used to report coordinates)
+LOG_LINE = re.compile(rb"^\s*(\d+)\s+(-?\d+)\s*$", re.MULTILINE)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert = commands.add_parser("convert", help="convert an emulator log with 'index value' lines into a layer dump")
+    convert.add_argument("log", help="emulator output, e.g. of print_intermediate_layer_head")
+    convert.add_argument("out", help="layer dump to write (.npz)")
+    convert.add_argument("-l", "--layer", type=int, required=True, help="layer the log belongs to")
+    convert.add_argument("-i", "--image", type=int, default=0, help="index of the image in the test set")
+
+    diff = commands.add_parser("diff", help="compare two layer dumps")
+    diff.add_argument("expected", help="reference layer dump, e.g. written by simulator.py --dump")
+    diff.add_argument("actual", help="layer dump to check, e.g. converted from an emulator log")
+    diff.add_argument("-l", "--layer", type=int, default=-1, help="only compare this layer")
+
+    return vars(parser.parse_args())
+
+
+def save_dump(path, images, layers, shapes=None, offsets=None):
+    # layers maps layer ids to (N, nodes) arrays
+    arrs = {"images": np.asarray(images, dtype=np.int64)}
+
+    for layer, nodes in layers.items():
+        arrs[f"layer_{layer}"] = nodes
+        if shapes is not None and layer in shapes:
+            arrs[f"shape_{layer}"] = np.asarray(shapes[layer], dtype=np.int64)
+        if offsets is not None and layer in offsets:
+            arrs[f"offset_{layer}"] = np.int64(offsets[layer])
+
+    np.savez_compressed(path, **arrs)
+
+
+def load_dump(path, only=None):
+    # returns the image indices and a dict of layers {id: {"nodes", "offset", "shape"}}. Layers are decompressed
+    # on access, so only the layers listed in only are loaded if it is given
+    with np.load(path) as f:
+        images = f["images"]
+        layers = {}
+
+        for key in f.files:
+            if not key.startswith("layer_"):
+                continue
+
+            layer = int(key[len("layer_"):])
+            if only is not None and layer not in only:
+                continue
+
+            layers[layer] = {
+                "nodes": f[key],
+                "offset": int(f[f"offset_{layer}"]) if f"offset_{layer}" in f.files else 0,
+                "shape": tuple(f[f"shape_{layer}"]) if f"shape_{layer}" in f.files else None,
+            }
+
+    return images, layers
 
-    sf_path = f"/root/nopu/tmp/simulator_layer_{l_id}.txt"
-    ef_path = f"/root/nopu/tmp/emulator_layer_{l_id}.txt"
 
-    with open(sf_path) as sf:
-        sf_lines = sf.read().splitlines()[3:]
+def parse_log(path):
+    # extract the "index value" lines from an emulator log. Everything else the emulator prints is skipped.
+    # Indices must be consecutive, e.g. as printed by print_intermediate_layer_head
+    with open(path, "rb") as f:
+        pairs = np.array(LOG_LINE.findall(f.read()), dtype=np.int64).reshape(-1, 2)
 
-    with open(ef_path) as ef:
-        ef_lines = ef.read().splitlines()
+    if len(pairs) == 0:
+        raise ValueError(f"no 'index value' lines in {path}")
 
-    ef_0 = 0
+    idx, values = pairs[:, 0], pairs[:, 1]
+    if not np.array_equal(idx, np.arange(idx[0], idx[0] + len(idx))):
+        raise ValueError(f"node indices in {path} are not consecutive")
 
-    while not "0 " in ef_lines[ef_0][:2]:
-        ef_0 += 1
+    return int(idx[0]), values
 
-    ef_lines = ef_lines[ef_0:]
-    count = 0
 
-    for i in range(len(sf_lines)):
-        try:
-            sf_val = int(sf_lines[i][sf_lines[i].find(" "):])
+def select(layer, idx, lo, hi):
+    # nodes lo to hi of the images at idx. Uses a view when all images are selected in order
+    nodes = layer["nodes"][:, lo - layer["offset"]:hi - layer["offset"]]
+
+    if np.array_equal(idx, np.arange(len(nodes))):
+        return nodes
+    return nodes[idx]
+
+
+def diff_layer(images_a, a, images_b, b):
+    # compare the images and nodes present in both dumps of a layer. Returns None if they do not overlap
+    common, ia, ib = np.intersect1d(images_a, images_b, return_indices=True)
+    lo = max(a["offset"], b["offset"])
+    hi = min(a["offset"] + a["nodes"].shape[1], b["offset"] + b["nodes"].shape[1])
+
+    if len(common) == 0 or lo >= hi:
+        return None
+
+    expected = select(a, ia, lo, hi)
+    actual = select(b, ib, lo, hi)
+
+    # compare in the stored types and only widen the mismatching nodes to compute errors
+    bad = expected != actual
+    mismatches = int(np.count_nonzero(bad))
+    err = np.abs(actual[bad].astype(np.int64) - expected[bad].astype(np.int64))
+
+    res = {"images": len(common), "nodes": hi - lo, "mismatches": mismatches, "max_error": int(err.max(initial=0))}
+
+    if mismatches > 0:
+        img, node = np.unravel_index(np.argmax(bad), bad.shape)
+        shape = a["shape"] or b["shape"]
+        res["first"] = {
+            "image": int(common[img]),
+            "node": lo + int(node),
+            "coords": tuple(int(c) for c in np.unravel_index(lo + node, shape)) if shape else None,
+            "expected": int(expected[img, node]),
+            "actual": int(actual[img, node]),
+        }
+
+    return res
+
+
+def print_diff(layer, res):
+    if res is None:
+        print(f"layer {layer}: no common images or nodes")
+        return
+
+    print(
+        f"layer {layer}: {res['mismatches']} of {res['images'] * res['nodes']} nodes differ "
+        f"({res['images']} images x {res['nodes']} nodes), max error {res['max_error']}"
+    )
+
+    if res["mismatches"] > 0:
+        first = res["first"]
+        coords = f" {first['coords']}" if first["coords"] else ""
+        print(
+            f"\tfirst mismatch: image {first['image']}, node {first['node']}{coords}: "
+            f"expected {first['expected']}, got {first['actual']}"
+        )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args["command"] == "convert":
+        offset, values = parse_log(args["log"])
+        save_dump(args["out"], [args["image"]], {args["layer"]: values[np.newaxis]}, offsets={args["layer"]: offset})
+        print(f"layer {args['layer']}: nodes {offset} to {offset + len(values) - 1} of image {args['image']}")
+    else:
+        only = [args["layer"]] if args["layer"] >= 0 else None
+        images_b, layers_b = load_dump(args["actual"], only)
+        images_a, layers_a = load_dump(args["expected"], list(layers_b))
+        common = sorted(layers_a)
 
-            ef_val = int(ef_lines[i][ef_lines[i].find(" "):])
-            count += 1
-                
-            if (sf_val != ef_val):
-                print(f"{i}: {sf_val}\t{ef_val}\tdiff:{ef_val-sf_val}")
-        except:
-            pass
-            
+        if not common:
+            raise ValueError("the dumps have no layers in common")
 
-    print("lines:", count)
\ No newline at end of file
+        for layer in common:
+            print_diff(layer, diff_layer(images_a, layers_a[layer], images_b, layers_b[layer]))
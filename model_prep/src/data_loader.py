@@ -1,13 +1,20 @@
-import tensorflow as tf
 # import tensorflow_datasets as tfds
 import numpy as np
 import pickle
+import json
 import os
 
 DATASETS = ["mnist", "cifar", "imgnet64"]
 IMGNET_PATH="../datasets/imagenet64/train"
+# decoded datasets are cached as uint8 .npy files next to the other datasets, independent of the working directory
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../datasets/cache")
+INDEX_FNAME = "index.json"
+
+# memory maps opened by this process, keyed by (dataset, split)
+_cache = {}
 
 def load_mnist():
+    import tensorflow as tf
 
     # Load MNIST dataset
     mnist = tf.keras.datasets.mnist
@@ -19,10 +26,63 @@ def load_mnist():
     return (train_images, train_labels), (test_images, test_labels)
 
 def load_cifar10():
+    import tensorflow as tf
+
     cifar10 = tf.keras.datasets.cifar10
     (train_images, train_labels), (test_images, test_labels) = cifar10.load_data()
     
     return (train_images, train_labels), (test_images, test_labels)
+
+def read_index():
+    index_path = os.path.join(CACHE_PATH, INDEX_FNAME)
+    if not os.path.isfile(index_path):
+        return {}
+
+    with open(index_path) as f:
+        return json.load(f)
+
+def build_cache(dataset):
+    # decode a dataset once (this is the only place that needs tensorflow) and store every split as a
+    # uint8 image array and a flat uint8 label array. A small json index records file names and shapes
+    if dataset == "mnist":
+        splits = load_mnist()
+    elif dataset == "cifar":
+        splits = load_cifar10()
+    else:
+        raise ValueError(f"can't cache dataset {dataset}")
+
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    entry = {}
+
+    for split, (images, labels) in zip(["train", "test"], splits):
+        images_fname = f"{dataset}_{split}_images.npy"
+        labels_fname = f"{dataset}_{split}_labels.npy"
+        np.save(os.path.join(CACHE_PATH, images_fname), np.ascontiguousarray(images, dtype=np.uint8))
+        np.save(os.path.join(CACHE_PATH, labels_fname), np.asarray(labels, dtype=np.uint8).reshape(-1))
+        entry[split] = {"images": images_fname, "labels": labels_fname, "shape": list(images.shape)}
+
+    index = read_index()
+    index[dataset] = entry
+    with open(os.path.join(CACHE_PATH, INDEX_FNAME), "w") as f:
+        json.dump(index, f, indent=4)
+
+def load_cached(dataset, split="test"):
+    # returns (images, labels) of a split as read-only memory maps. Nothing is decoded or copied, so a single
+    # image can be fetched by index right away. The cache is built on first use
+    key = (dataset, split)
+
+    if key not in _cache:
+        index = read_index()
+        if dataset not in index:
+            build_cache(dataset)
+            index = read_index()
+
+        entry = index[dataset][split]
+        images = np.load(os.path.join(CACHE_PATH, entry["images"]), mmap_mode="r")
+        labels = np.load(os.path.join(CACHE_PATH, entry["labels"]), mmap_mode="r")
+        _cache[key] = (images, labels)
+
+    return _cache[key]
 """
 def load_imgnet64():
     def load_databatch(data_folder, idx, img_size=64):
@@ -0,0 +1,285 @@
+import argparse
+import math
+import os
+import re
+
+# analytical cycle model of the accelerator. Every layer is described by the same words that network-configs.h
+# sends to the coprocessor (type, activation, shape_in, shape_out), and the cycle counts follow the state machines
+# in LayerConv.scala, LayerMaxPool.scala, LayerFc.scala and CnnAccelerator.scala state by state
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../hardware_test/network-configs.h")
+
+# layer types and fc activations as encoded in Config.scala and network-configs.h
+FC = 2
+CONV = 3
+POOL = 4
+FC_REQUANTIZE = 12
+FC_WRITE_BIAS = 11
+TYPE_NAMES = {FC: "fc", CONV: "conv", POOL: "pool"}
+
+# net cycles per inference of load_nn_cifar_10 in the patmos emulator (see README)
+REFERENCE_CYCLES = 1405550
+# max frequency of the accelerator on the FPGA in Hz
+CLOCK = 80e6
+# words per sram burst
+BURST_LENGTH = 4
+# the input image occupies the first 3072 words of bram
+IMG_CHUNK_SIZE = 3072
+# CnnAccelerator flushes 16 words beyond every layer
+FLUSH_MARGIN = 16
+# parallel multipliers: one per filter tap in conv_apply_filter, one per weight of a burst in fc_mac
+FC_LANES = 16
+
+# average number of cycles a layer spends in a state that issues an sram burst read, from request to sram_done.
+# This is the only parameter of the model that does not follow from the hdl. Fitted on REFERENCE_CYCLES, the only
+# measurement there is, so the error against it is in-sample and says nothing about how well the model predicts
+SRAM_BURST_CYCLES = 28.71
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--config",
+        default=CONFIG_PATH,
+        help="network configuration header to read the layers from",
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        nargs="*",
+        default=[],
+        help="tflite models to estimate instead of the configuration header. Several models are ranked by latency",
+    )
+    parser.add_argument(
+        "-s",
+        "--sram_cycles",
+        type=float,
+        default=SRAM_BURST_CYCLES,
+        help="cycles per sram burst read",
+    )
+    parser.add_argument(
+        "--calibrate",
+        type=int,
+        default=0,
+        help="fit the sram burst cycles so that the configuration takes the given number of cycles (e.g. 1405550)",
+    )
+
+    return vars(parser.parse_args())
+
+
+def parse_config(path=CONFIG_PATH):
+    # read the layers from the cop_config calls of a network configuration header. Symbolic values (layer types
+    # and activations) are resolved through the constants defined in the header, parameter addresses are ignored
+    with open(path) as f:
+        src = f.read()
+
+    consts = {name: int(val, 0) for name, val in re.findall(r"const\s+uint\s+(\w+)\s*=\s*(\w+)\s*;", src)}
+    layers = {}
+    num_layers = 0
+
+    for layer, field, val in re.findall(r"cop_config\(\s*(\d+)\s*,\s*(\d+)\s*,\s*([^)]+?)\s*\)\s*;", src):
+        layer, field = int(layer), int(field)
+
+        if field == 8:
+            num_layers = int(val, 0)
+            continue
+
+        if val.startswith("&"):
+            continue
+        val = consts[val] if val in consts else int(val, 0)
+
+        keys = {0: "type", 1: "activation", 4: "shape_in", 5: "shape_out"}
+        if field in keys:
+            layers.setdefault(layer, {})[keys[field]] = val
+
+    return [layers[i] for i in range(num_layers)]
+
+
+def plan_to_config(plan):
+    # encode the steps of a simulator plan like network-configs.h does
+    layers = []
+
+    for step in plan["steps"]:
+        if step["type"] == "conv":
+            w, _, c_in = step["in_shape"]
+            f_x, _ = step["f_shape"]
+            c_out = step["out_shape"][-1]
+            layer = {"type": CONV, "activation": 0, "shape_in": (w << 24) | (f_x << 16) | (c_in << 8) | c_out}
+        elif step["type"] == "pool":
+            w, _, c = step["in_shape"]
+            p_x, _ = step["p_shape"]
+            out = step["out_shape"][0]
+            layer = {
+                "type": POOL,
+                "activation": 0,
+                "shape_in": (w << 24) | (p_x << 20) | (step["stride"] << 16) | (out << 8) | c,
+            }
+        else:
+            activation = FC_REQUANTIZE if step["m_id"] is not None else FC_WRITE_BIAS
+            layer = {"type": FC, "activation": activation, "shape_in": step["in_shape"][0]}
+
+        layer["shape_out"] = math.prod(step["out_shape"])
+        if layer["type"] == FC:
+            # fc biases are written in bursts, so the hardware holds whole bursts of outputs (10 classes take 12)
+            layer["shape_out"] = math.ceil(layer["shape_out"] / BURST_LENGTH) * BURST_LENGTH
+        layers.append(layer)
+
+    return layers
+
+
+def load_model(path):
+    # the simulator derives the layer shapes from the tflite operators, just like for inference
+    import tensorflow as tf
+    import simulator
+
+    interpreter = tf.lite.Interpreter(model_path=path)
+    interpreter.allocate_tensors()
+
+    return plan_to_config(simulator.build_plan(interpreter))
+
+
+def conv_cycles(shape_in):
+    # returns (fixed cycles, sram bursts, multiply-accumulates, parallel multipliers) of a conv layer.
+    # For every filter and input channel, one burst loads the 2d filter. Every output then takes 9 conv_load_input,
+    # conv_apply_filter, conv_sum_output and conv_write_output, and conv_wr_addr_set between two outputs. The last
+    # input channel of a filter adds conv_add_bias, conv_requantize and conv_apply_relu per output. Each filter
+    # loads its bias in one burst, and all m factors are loaded up front, four per burst
+    w = shape_in >> 24
+    f = (shape_in >> 16) & 0xFF
+    c_in = (shape_in >> 8) & 0xFF
+    c_out = shape_in & 0xFF
+    positions = (w - f + 1) ** 2
+
+    per_slice = positions * (f * f + 3) + (positions - 1)
+    fixed = 1 + c_out * c_in * per_slice + c_out * 3 * positions + 1
+    bursts = math.ceil(c_out / BURST_LENGTH) + c_out + c_out * c_in
+    macs = c_out * c_in * positions * f * f
+
+    return fixed, bursts, macs, f * f
+
+
+def pool_cycles(shape_in):
+    # every comparison takes pool_rd_addr_set and pool_find_max, every output one pool_write_output. x and y run
+    # from 0 to the output width inclusive, so the state machine visits (out + 1)^2 windows per channel
+    p = (shape_in >> 20) & 0xF
+    out = (shape_in >> 8) & 0xFF
+    c = shape_in & 0xFF
+
+    fixed = 1 + c * (out + 1) ** 2 * (2 * p * p + 1) + 1
+
+    return fixed, 0, 0, 0
+
+
+def fc_cycles(shape_in, shape_out, activation):
+    # for every input, fc_load_input and then one pass over groups of 16 outputs: a weight burst, 17 cycles of
+    # fc_load_output, fc_mac, and fc_write_output writing the group plus one cycle to move on. Afterwards the
+    # outputs get their biases in groups of 4: 5 cycles of fc_load_output, a bias burst, fc_add_bias, the optional
+    # fc_requantize and fc_apply_relu, and 5 cycles of fc_write_bias. m is loaded once
+    groups = math.ceil(shape_out / FC_LANES)
+    per_input = 1 + sum(17 + 1 + min(FC_LANES, shape_out - FC_LANES * g) + 1 for g in range(groups))
+    bias_groups = math.ceil(shape_out / BURST_LENGTH)
+    requantize = 2 if activation == FC_REQUANTIZE else 0
+
+    fixed = 1 + shape_in * per_input + bias_groups * (5 + 1 + requantize + 5) + 1
+    bursts = 1 + shape_in * groups + bias_groups
+    macs = shape_in * shape_out
+
+    return fixed, bursts, macs, FC_LANES
+
+
+def layer_cycles(layer):
+    if layer["type"] == CONV:
+        return conv_cycles(layer["shape_in"])
+    elif layer["type"] == POOL:
+        return pool_cycles(layer["shape_in"])
+    elif layer["type"] == FC:
+        return fc_cycles(layer["shape_in"], layer["shape_out"], layer["activation"])
+    else:
+        raise ValueError(f"unknown layer type {layer['type']}")
+
+
+def estimate(layers, sram_cycles=SRAM_BURST_CYCLES):
+    # per-layer cycle estimates of a full inference. Besides running the layer, CnnAccelerator spends next_layer,
+    # set_offset, layer_done and one clear_layer cycle per word of the previous layer (the image for layer 0) plus
+    # FLUSH_MARGIN. After the last layer, find_max reads all outputs and reset_memory clears them again
+    report = {"layers": [], "fixed": 1, "bursts": 0}
+    prev_size = IMG_CHUNK_SIZE
+
+    for layer in layers:
+        compute, bursts, macs, lanes = layer_cycles(layer)
+        flush = 3 + prev_size + FLUSH_MARGIN + 1
+        prev_size = layer["shape_out"]
+
+        report["layers"].append(
+            {
+                "type": TYPE_NAMES[layer["type"]],
+                "compute": compute + bursts * sram_cycles,
+                "flush": flush,
+                "bursts": bursts,
+                "macs": macs,
+                "lanes": lanes,
+            }
+        )
+        report["fixed"] += compute + flush
+        report["bursts"] += bursts
+
+    out_size = layers[-1]["shape_out"]
+    report["output"] = 2 * (out_size + 1) + 1 + 2 * (out_size + FLUSH_MARGIN) + 1
+    report["fixed"] += report["output"]
+    report["total"] = report["fixed"] + report["bursts"] * sram_cycles
+
+    return report
+
+
+def calibrate(layers, measured):
+    # the model is linear in the sram burst cycles, so one measurement determines them
+    report = estimate(layers, 0)
+
+    return (measured - report["fixed"]) / report["bursts"]
+
+
+def print_report(report):
+    print(f"{'layer':>5} {'type':>5} {'cycles':>10} {'flush':>7} {'share':>7} {'MACs':>9} {'MAC/cycle':>9} {'util':>6}")
+
+    for i, layer in enumerate(report["layers"]):
+        cycles = layer["compute"] + layer["flush"]
+        rate = layer["macs"] / cycles
+        util = f"{100 * rate / layer['lanes']:5.1f}%" if layer["lanes"] else "-"
+        print(
+            f"{i:>5} {layer['type']:>5} {cycles:>10.0f} {layer['flush']:>7} {100 * cycles / report['total']:>6.1f}% "
+            f"{layer['macs']:>9} {rate:>9.3f} {util:>6}"
+        )
+
+    print(f"{'':>5} {'out':>5} {report['output']:>10} {'':>7} {100 * report['output'] / report['total']:>6.1f}%")
+    macs = sum(layer["macs"] for layer in report["layers"])
+    print(
+        f"total: {report['total']:.0f} cycles ({report['bursts']} sram bursts), {1000 * report['total'] / CLOCK:.2f} ms "
+        f"at {CLOCK / 1e6:.0f} MHz, {macs / report['total']:.3f} MACs/cycle"
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args["calibrate"] > 0:
+        sram_cycles = calibrate(parse_config(args["config"]), args["calibrate"])
+        print(f"{sram_cycles:.2f} cycles per sram burst")
+    elif args["model"]:
+        reports = [(path, estimate(load_model(path), args["sram_cycles"])) for path in args["model"]]
+
+        for path, report in reports:
+            print(f"========= {path} =========")
+            print_report(report)
+
+        if len(reports) > 1:
+            print("========= ranking =========")
+            for path, report in sorted(reports, key=lambda r: r[1]["total"]):
+                print(f"{report['total']:>12.0f} cycles {1000 * report['total'] / CLOCK:>8.2f} ms  {path}")
+    else:
+        report = estimate(parse_config(args["config"]), args["sram_cycles"])
+        print_report(report)
+        print(
+            f"emulator reference: {REFERENCE_CYCLES} cycles ({100 * (report['total'] / REFERENCE_CYCLES - 1):+.3f}%, "
+            f"in-sample: the sram burst cycles are fitted to it)"
+        )
@@ -1,20 +1,35 @@
 # standard libs
 import argparse
-import enum
-import sys
-
-# local
-import models
+import time
+import tracemalloc
+from multiprocessing import Pool, shared_memory
 
 # 3rd party
-import tensorflow as tf
 import numpy as np
 import data_loader
+import compare_output
 
 # constants
-MODELS = models.DESCRIPTOR_LIST
-DTYPE = np.float64
+# tflite operators without a counterpart on the accelerator. Flattening is implicit in fc layers
+IGNORED_OPS = ["QUANTIZE", "DEQUANTIZE", "RESHAPE", "SOFTMAX"]
+DTYPE_ACC = np.int32
 DTYPE_WEIGHTS = np.int8
+# float64 represents every integer below 2^53 exactly, so integer products can run through BLAS as long as
+# no partial sum can grow that large
+FLOAT_EXACT_LIMIT = 2**53
+# largest magnitude of a single uint8 activation x int8 weight product
+MAX_PRODUCT = 255 * 128
+# the accelerator requantizes with a 32 bit fixed-point multiplier M0 = M * 2^32 followed by a 32 bit shift
+M_SHIFT = 32
+# images per chunk in batch mode. Bounds the memory used by the im2col buffers
+BATCH_SIZE = 250
+# plan entries holding parameter arrays. These are placed in shared memory for worker processes
+PARAM_KEYS = ["kernels", "int_kernels", "biases", "Ms", "M0s"]
+# batches per work item handed to a worker process
+BATCHES_PER_SHARD = 4
+
+# per-process state of a worker process: the attached plan, its shared memory blocks, and an arena
+_worker = {}
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -53,388 +68,445 @@ def parse_args():
         default="../models/8x32_model_qat.tflite",
         help="specify which model to simulate. Full path (absolute or relative)",
     )
+    parser.add_argument("--top10", action="store_true", help="calculate the first then images")
+    parser.add_argument("--full", action="store_true", help="evaluate the full cifar test set (10000 images) in batch mode")
     parser.add_argument(
-        "-t",
-        "--type",
-        type=str,
-        default="min_pool",
-        help="specify the model architecture. One of " + str(MODELS)
+        "-b",
+        "--batch_size",
+        type=int,
+        default=BATCH_SIZE,
+        help="number of images processed at once in batch mode",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes in batch mode. Set OMP_NUM_THREADS=1 to keep BLAS from oversubscribing cores",
+    )
+    parser.add_argument(
+        "--fixed_point",
+        action="store_true",
+        help="integer-only mode: requantize with the same int32 multipliers and shift as the accelerator",
+    )
+    parser.add_argument(
+        "--dump",
+        default="",
+        help="write the outputs of all layers to a compressed .npz layer dump (see compare_output.py)",
+    )
+    parser.add_argument(
+        "--num_images",
+        type=int,
+        default=1,
+        help="number of images to dump, starting at --image",
     )
-    parser.add_argument("--top10", action="store_true", help="calculate the first then images")
     args = vars(parser.parse_args())
     return args
 
-def get_layer_ids(layers):
-    fcs = []
-    bas = []
-    convs = []
-
-
-    for layer_id in layers.keys():
-        name = layers[layer_id]["name"]
-        if "/MatMul" in name and not "/BiasAdd" in name:
-            fcs.append(layer_id)
-        elif ("/bias" in name and not "quant" in name) or ("/BiasAdd" in name and not ";" in name):
-            bas.append(layer_id)
-        elif "/Conv2D" in name and not "/BiasAdd" in name:
-            convs.append(layer_id)
-
-    return fcs, bas, convs
-
-def find_ms(layers):
-    bias_s = []
-    activation_s = []
-    Ms = []
-
-    for layer_id in layers.keys():
-        name = layers[layer_id]["name"]
-        if ("/bias" in name and not "quant" in name) or ("/BiasAdd" in name and not ";" in name):
-            bias_s.append(layers[layer_id]["qp"]["scales"])
-        elif "/Relu" in name:
-            activation_s.append(layers[layer_id]["qp"]["scales"])
-
-    for i in range(len(bias_s) - 1):
-        Ms.append(bias_s[i] / activation_s[i])
-
-    return Ms
-
-def init_nodes(bas, layers):
-    nodes = []
-    for ba in bas:
-        nodes.append(np.zeros(layers[ba]["tensor"].size, dtype=DTYPE))
-
-    return nodes
+def load_tensor(interpreter, tensor_id):
+    return interpreter.get_tensor(tensor_id)
+
+def get_shape(tensor_details):
+    # drop the batch dimension of the tflite tensor
+    return tuple(int(d) for d in tensor_details["shape"][1:])
+
+def get_scales(tensor_details):
+    return tensor_details["quantization_parameters"]["scales"]
+
+def build_plan(interpreter):
+    # translate the tflite operator list into a sequence of accelerator layers. Shapes, weights, biases, and
+    # requantization factors are extracted once here, so running the plan only does the arithmetic
+    tensors = {}
+    for details in interpreter.get_tensor_details():
+        tensors[details["index"]] = details
+
+    in_shape = get_shape(tensors[interpreter.get_input_details()[0]["index"]])
+    plan = {"in_shape": in_shape, "steps": [], "kernels": [], "int_kernels": [], "biases": [], "Ms": [], "M0s": []}
+    steps = plan["steps"]
+
+    for op in interpreter._get_ops_details():
+        name = op["op_name"]
+        inputs, outputs = op["inputs"], op["outputs"]
+
+        if name in IGNORED_OPS:
+            continue
+
+        in_details = tensors[inputs[0]]
+        out_details = tensors[outputs[0]]
+        step = {"in_shape": get_shape(in_details), "out_shape": get_shape(out_details), "m_id": None}
+
+        if name == "CONV_2D":
+            filter = load_tensor(interpreter, inputs[1])
+            c_out, f_x, f_y, c_in = filter.shape
+            in_x, in_y, in_z = step["in_shape"]
+
+            if step["out_shape"] != (in_x - f_x + 1, in_y - f_y + 1, c_out):
+                raise ValueError(f"{out_details['name']}: only valid convolutions with stride 1 are supported")
+
+            # im2col layout: one row per output pixel, one column per filter
+            step["type"] = "conv"
+            step["f_shape"] = (f_x, f_y)
+            step["rows"] = (in_x - f_x + 1) * (in_y - f_y + 1)
+            step["depth"] = c_in * f_x * f_y
+            kernel = np.transpose(filter, (3, 1, 2, 0)).reshape(step["depth"], c_out)
+        elif name == "MAX_POOL_2D":
+            if len(steps) == 0:
+                raise ValueError("the first layer must be a conv or fc layer")
+
+            # pool size and stride are not exposed by the interpreter. max_pool handles any combination, but
+            # they are inferred assuming the Keras MaxPooling2D default of a stride equal to the pool size
+            stride = step["in_shape"][0] // step["out_shape"][0]
+            step["type"] = "pool"
+            step["p_shape"] = (stride, stride)
+            step["stride"] = stride
+
+            if any((w - stride) // stride + 1 != o for w, o in zip(step["in_shape"][:2], step["out_shape"][:2])):
+                raise ValueError(f"{out_details['name']}: cannot infer pool size and stride")
+        elif name == "FULLY_CONNECTED":
+            step["type"] = "fc"
+            step["in_shape"] = (int(np.prod(step["in_shape"])),)
+            step["rows"] = 1
+            step["depth"] = step["in_shape"][0]
+            kernel = np.transpose(load_tensor(interpreter, inputs[1]), (1, 0))
+        else:
+            raise ValueError(f"operator {name} is not supported by the accelerator")
+
+        if step["type"] != "pool":
+            # int8 x uint8 products are exact in float64, see int_matmul. Sums only need to be wrapped if they
+            # can leave the int32 range
+            bound = step["depth"] * MAX_PRODUCT
+            if bound >= FLOAT_EXACT_LIMIT:
+                raise ValueError(f"{out_details['name']}: layer too deep for exact float64 accumulation")
+
+            step["wrap"] = bound >= 2**31
+            # kernels in the matmul operand type of either mode, so arenas and worker processes use them as they are
+            step["kernel_id"] = len(plan["kernels"])
+            plan["kernels"].append(kernel.astype(np.float64))
+            plan["int_kernels"].append(kernel.astype(np.int64))
+            step["bias_id"] = len(plan["biases"])
+            step["bias_scales"] = get_scales(tensors[inputs[2]])
+            step["out_scales"] = get_scales(out_details)
+            plan["biases"].append(load_tensor(interpreter, inputs[2]))
+
+        steps.append(step)
+
+    # every layer with weights but the last one is requantized back to 8 bit. The last one only adds biases
+    mac_steps = [step for step in steps if step["type"] != "pool"]
+    for step in mac_steps[:-1]:
+        step["m_id"] = len(plan["Ms"])
+        plan["Ms"].append(step["bias_scales"] / step["out_scales"])
+        plan["M0s"].append(to_fixed_point(plan["Ms"][-1]))
+
+    return plan
+
+def to_fixed_point(M):
+    # same conversion as gen_c_arrs.parse_m. The hardware reads the 32 bit word as a signed factor, so
+    # multipliers of 2^31 and above wrap around, just like they do on the accelerator
+    M0 = np.trunc(np.asarray(M, dtype=np.float64) * 2**M_SHIFT).astype(np.int64)
+    return M0.astype(np.int32).astype(np.int64)
 
 def load_input(id, dataset):
-    if dataset == "mnist":
-        (_, _), (test_images, test_labels) = data_loader.load_mnist()
-    elif dataset == "cifar":
-        (_, _), (test_images, test_labels) = data_loader.load_cifar10()
+    test_images, test_labels = data_loader.load_cached(dataset)
 
     return test_images[id], test_labels[id]
 
-def load_weights(fcs, layers):
-    weights = []
-    for fc in fcs:
-        weights.append(np.transpose(layers[fc]["tensor"], (1, 0)))
-    return weights
-
-def load_biases(bas, layers):
-    biases = []
-    for ba in bas:
-        biases.append(layers[ba]["tensor"])
-    return biases
-
-def load_filters(convs, layers):
-    filters = []
-    for conv in convs:
-        filters.append(layers[conv]["tensor"])
-
-    return filters
-
-def mac_fc(input, output, weights, mac_id):
-    for in_id in range(len(input)):
-        for out_id in range(len(output)):
-            in_param = input[in_id].astype(DTYPE)
-            weight = weights[mac_id][in_id, out_id].astype(DTYPE)
-            output[out_id] = output[out_id] + in_param * weight
-
-def apply_filter(ins, filter):
-    return np.multiply(ins, filter).sum()
-
-def extract_input(in_volume, filter_size, x, y):
-    if filter_size == 3:
-        return in_volume[x - 1 : x + 2, y - 1 : y + 2, :]
-    elif filter_size == 5:
-        return in_volume[x - 2 : x + 3, y - 2 : y + 3, :]
-    else:
-        sys.exit("FILTER SIZE NOT IMPLEMENTED")
-
-def conv(input_layer, output, filters, layer, input_shape, filter_id):
-    # input dimensions of image (28x28x1 for MNIST)
-    in_x, in_y, in_z = input_shape
-    c_out, f_x, f_y, c_in = filters[filter_id].shape # in_z and c_in are the same number
-    out_x, out_y = in_x - f_x + 1, in_y - f_y + 1
-    outputs = np.zeros((out_x, out_y, c_out), dtype=DTYPE)
-    # for every kernel, produce an output mask
-    for a in range(c_out):
-        # init output mask
-        out_mask = np.zeros((out_x, out_y), dtype=DTYPE)
-        # load corresponding filter
-        filter = filters[filter_id][a]
-
-        # iterate over input image (and ignore edges) and map to output masks
-        for x in range(1, in_x - 1):
-            for y in range(1, in_y - 1):
-                ins = extract_input(input_layer, f_x, x, y)
-                out_mask[x - 1, y - 1] = apply_filter(ins, filter)
-
-        outputs[:, :, a] = out_mask
-
-
-    output[layer] = outputs
+def extract_input(in_volume, f_x, f_y):
+    # strided view of every filter-sized window of the input volume, shape (out_x, out_y, c_in, f_x, f_y).
+    # No data is copied and any filter size works, as long as it fits into the input
+    return np.lib.stride_tricks.sliding_window_view(in_volume, (f_x, f_y), axis=(-3, -2))
+
+def init_arena(plan, batch_size, fixed_point=False):
+    # allocate every buffer needed to run the plan on up to batch_size images, once. Activations ping-pong
+    # between two uint8 buffers like the even and odd halves of the accelerator's bram. Sums live in one int32
+    # buffer, matmul operands (im2col) and products in two buffers shared by all layers. These are float64 to
+    # use BLAS, or int64 in fixed-point mode, which then uses no floating point at all. The kernels of the
+    # plan already have the matching type and are only referenced
+    dtype = np.int64 if fixed_point else np.float64
+    act_size = acc_size = col_size = 0
+
+    for step in plan["steps"]:
+        out_size = int(np.prod(step["out_shape"]))
+        act_size = max(act_size, out_size)
+
+        if step["type"] != "pool":
+            acc_size = max(acc_size, out_size)
+            col_size = max(col_size, step["rows"] * step["depth"])
+
+    return {
+        "batch_size": batch_size,
+        "fixed_point": fixed_point,
+        "kernels": plan["int_kernels"] if fixed_point else plan["kernels"],
+        "acts": [np.zeros(batch_size * act_size, dtype=np.uint8), np.zeros(batch_size * act_size, dtype=np.uint8)],
+        "acc": np.zeros(batch_size * acc_size, dtype=DTYPE_ACC),
+        "cols": np.zeros(batch_size * col_size, dtype=dtype),
+        "prod": np.zeros(batch_size * acc_size, dtype=dtype),
+    }
+
+def arena_bytes(arena):
+    buffers = arena["acts"] + [arena["acc"], arena["cols"], arena["prod"]]
+    return sum(buffer.nbytes for buffer in buffers)
+
+def get_view(buffer, shape):
+    return buffer[:int(np.prod(shape))].reshape(shape)
+
+def int_matmul(a, b, out, scratch, wrap=False):
+    # exact integer product a @ b (a of shape (k,) or (n, k), b of shape (k, m)), written into the int32 array out.
+    # a and b are int64 arrays or float64 arrays holding integers: int8 x uint8 products summed over k values stay
+    # far below 2^53 (checked in build_plan), so BLAS gives exact results. With wrap, sums are folded into the int32
+    # range like the accelerator's 32 bit accumulators do on overflow. scratch has the type of a and b, shape of out
+    np.matmul(a, b, out=scratch)
+
+    if wrap:
+        np.add(scratch, 2**31, out=scratch)
+        np.mod(scratch, 2**32, out=scratch)
+        np.subtract(scratch, 2**31, out=scratch)
+
+    np.copyto(out, scratch, casting="unsafe")
+
+def mac_fc(layer_in, kernel, acc, arena, wrap):
+    cols = get_view(arena["cols"], acc.shape[:-1] + kernel.shape[:1])
+    np.copyto(cols, layer_in.reshape(cols.shape))
+    int_matmul(cols, kernel, acc, get_view(arena["prod"], acc.shape), wrap)
+
+def conv(layer_in, kernel, f_shape, acc, arena, wrap):
+    # im2col: copy all windows into the column buffer and reduce them against all filters in a single
+    # integer matrix multiply. Summation order does not matter for wrapping 32 bit integer arithmetic,
+    # so the result is bit-exact with LayerConv, which accumulates one input channel at a time.
+    # Leading axes (if any) index images of a batch
+    f_x, f_y = f_shape
+    windows = extract_input(layer_in, f_x, f_y)
+    cols = get_view(arena["cols"], windows.shape)
+    np.copyto(cols, windows)
+
+    rows = cols.reshape(-1, kernel.shape[0])
+    out = acc.reshape(-1, kernel.shape[1])
+    int_matmul(rows, kernel, out, get_view(arena["prod"], out.shape), wrap)
 
 def calc_flat_address(x, y, z, mx, my, mz):
     return x * mz + y * mz * mx + z
 
 def flatten(nodes, layer):
-    x, y, z = nodes[layer].shape
-    nodes[layer] = nodes[layer].reshape(x * y * z)
-
-def max_pool(nodes, in_shape, out_shape, p_shape, layer):
-    inx, iny, inz = in_shape
-    outx, outy, outz = out_shape
-    px, py = p_shape
-    pool_output = np.zeros(out_shape).astype(np.uint8)
-    layer_in = nodes[layer - 1]
-    stride = 2
-
-    for z in range(inz):
-        for y in range(int(iny/stride)):
-            for x in range(int(inx/stride)):
-                max_val = int(-sys.maxsize - 1)
-                for fx in range(px):
-                    for fy in range(py):
-                        max_val = max(max_val, layer_in[stride * x + fx, stride * y + fy, z])
-                pool_output[x, y, z] = max_val
-
-    nodes.insert(layer, pool_output)
-
-def bias_conv(outputs, biases):
-    x, y, z = outputs.shape
-    for i in range(x):
-        for j in range(y):
-            for k in range(z):
-                outputs[i, j, k] = outputs[i, j, k] + biases[k]
-
-def relu(outputs, conv):
-    if conv:
-        x, y, z = outputs.shape
-        for i in range(x):
-            for j in range(y):
-                for k in range(z):
-                    outputs[i, j, k] = min(max(outputs[i, j, k], 0), 255)
-    else:
-        for id in range(len(outputs)):
-            outputs[id] = min(max(outputs[id], 0), 255)
-
-def type_cast(outputs, layer):
-    outputs[layer] = outputs[layer].astype(np.uint8)
-
-def bias(outputs, biases):
-    for id in range(len(outputs)):
-        outputs[id] = outputs[id] + biases[id]
-
-def requantize_activations(outputs, layer, M, conv):
-    if conv:
-        output_q = np.zeros(outputs[layer].shape)
-        for channel in range(len(M)):
-            output_q[:, :, channel] = outputs[layer][:, :, channel] * M[channel]
-        
-        outputs[layer] = output_q
+    # flattens the last three axes and keeps the batch axis, if there is one
+    *lead, x, y, z = nodes[layer].shape
+    nodes[layer] = nodes[layer].reshape(tuple(lead) + (x * y * z,))
+
+def max_pool(layer_in, out, p_shape, stride):
+    # max pooling over a single volume or a whole batch. Every position within the pool window is one strided
+    # view of the input covering all windows, so the pool size (p_x x p_y) sets the number of vectorized
+    # np.maximum calls. Like LayerMaxPool, windows start at multiples of stride and only whole windows are pooled:
+    # the output size is (w - p) // stride + 1, which drops an odd trailing edge
+    p_x, p_y = p_shape
+    out_x, out_y = out.shape[-3:-1]
+
+    for f_x in range(p_x):
+        for f_y in range(p_y):
+            window = layer_in[
+                ..., f_x : f_x + stride * (out_x - 1) + 1 : stride, f_y : f_y + stride * (out_y - 1) + 1 : stride, :
+            ]
+
+            if f_x == 0 and f_y == 0:
+                np.copyto(out, window)
+            else:
+                np.maximum(out, window, out=out)
+
+def epilogue(acc, bias, M, out, scratch):
+    # fused, in-place layer epilogue: add biases and, unless this is the output layer (M is None), requantize,
+    # cap to 8-bit unsigned int range and cast into out. Conv layers have one bias and M per output channel
+    # (last axis), fc layers one bias per node and a single M
+    np.add(acc, bias, out=acc)
+
+    if M is None:
+        return
+
+    np.multiply(acc, M, out=scratch)
+    np.clip(scratch, 0, 255, out=scratch)
+    np.copyto(out, scratch, casting="unsafe")
+
+def epilogue_fixed_point(acc, bias, M0, out, scratch):
+    # integer-only version of epilogue, identical to the accelerator: (acc + bias) * M0 >> 32 on 64 bit, then
+    # cap the lower 32 bits to 8-bit unsigned int range. |acc * M0| < 2^62, so the shifted result always fits
+    # into 32 bits and the truncation can be skipped. scratch is an int64 buffer shaped like acc
+    np.add(acc, bias, out=acc)
+
+    if M0 is None:
+        return
+
+    np.multiply(acc, M0, out=scratch)
+    np.right_shift(scratch, M_SHIFT, out=scratch)
+    np.clip(scratch, 0, 255, out=scratch)
+    np.copyto(out, scratch, casting="unsafe")
+
+def run_plan(plan, imgs, arena=None, nodes=None, fixed_point=False):
+    # run a single image (H x W x C) or a stack of images (N x H x W x C) through all layers of the plan, using
+    # the buffers of arena. Returns the output layer, which is a view into the arena. If a list is passed as
+    # nodes, a copy of every layer's output is appended to it. fixed_point only applies to a newly created arena
+    steps, biases = plan["steps"], plan["biases"]
+    lead = imgs.shape[:imgs.ndim - len(plan["in_shape"])]
+    num_imgs = int(np.prod(lead))
+
+    if arena is None:
+        arena = init_arena(plan, num_imgs, fixed_point)
+    elif num_imgs > arena["batch_size"]:
+        raise ValueError(f"arena holds {arena['batch_size']} images, got {num_imgs}")
+
+    kernels = arena["kernels"]
+
+    # per-layer requantization factors and epilogue, floating point or fixed-point
+    if arena["fixed_point"]:
+        Ms, finish = plan["M0s"], epilogue_fixed_point
     else:
-        output_q = outputs[layer] * M
-        outputs[layer] = output_q
-
-def process_model_basic_fc(nodes, img, weights, filters, biases, Ms):
-    # a little hack to ensure backwards compatibility (first layer FC)
-    image_as_list = [img]
-    flatten(image_as_list, 0)
-    img = image_as_list[0]
-
-    # layer 0
-    mac_fc(img, nodes[0], weights, 0)
-    bias(nodes[0], biases[0])
-    requantize_activations(nodes, 0, Ms[0], False)
-    relu(nodes[0], False)
-    type_cast(nodes, 0)
-    
-    # last layer
-    mac_fc(nodes[0], nodes[1], weights, 1)
-    bias(nodes[1], biases[1])
-
-    return np.argmax(nodes[-1])
-
-def process_model_three_fc(nodes, img, weights, filters, biases, Ms):
-    # a little hack to ensure backwards compatibility (first layer FC)
-    image_as_list = [img]
-    flatten(image_as_list, 0)
-    img = image_as_list[0]
-
-    # layer 0
-    mac_fc(img, nodes[0], weights, 0)
-    bias(nodes[0], biases[0])
-    requantize_activations(nodes, 0, Ms[0], False)
-    relu(nodes[0], False)
-    type_cast(nodes, 0)
-
-    # intermediate layer
-    mac_fc(nodes[0], nodes[1], weights, 1)
-    bias(nodes[1], biases[1])
-    requantize_activations(nodes, 1, Ms[1], False)
-    relu(nodes[1], False)
-    type_cast(nodes, 1)
-    
-    # last layer
-    mac_fc(nodes[1], nodes[2], weights, 2)
-    bias(nodes[2], biases[2])
-
-    return np.argmax(nodes[-1])
-
-def process_model_conv_minimal(nodes, img, weights, filters, biases, Ms):
-    # layer 0
-    conv(img, nodes, filters, 0, (28, 28, 1), 0)
-    bias_conv(nodes[0], biases[0])
-    requantize_activations(nodes, 0, Ms[0], True)
-    relu(nodes[0], True)
-    type_cast(nodes, 0)
-
-    # flatten
-    flatten(nodes, 0)
-
-    # layer 1
-    mac_fc(nodes[0], nodes[1], weights, 0)
-    bias(nodes[1], biases[1])
-
-    return np.argmax(nodes[-1])
-
-def process_model_min_pool(nodes, img, weights, filters, biases, Ms):
-    # layer 0
-    conv(img, nodes, filters, 0, (28, 28, 1), 0)
-    bias_conv(nodes[0], biases[0])
-    requantize_activations(nodes, 0, Ms[0], True)
-    relu(nodes[0], True)
-    type_cast(nodes, 0)
-
-    # layer 1: max-pool (2x2)
-    max_pool(nodes, (26, 26, 16), (13, 13, 16), (2, 2), 1)
-
-    # flatten
-    flatten(nodes, 1)
-
-    # layer 3
-    mac_fc(nodes[1], nodes[2], weights, 0)
-    bias(nodes[2], biases[1])
-
-    return np.argmax(nodes[-1])
-
-def process_model_basic_conv(nodes, img, weights, filters, biases, Ms):
-    # layer 0
-    conv(img, nodes, filters, 0, (28, 28, 1), 0)
-    bias_conv(nodes[0], biases[0])
-    requantize_activations(nodes, 0, Ms[0], True)
-    relu(nodes[0], True)
-    type_cast(nodes, 0)
-
-    # layer 1: max-pool (2x2)
-    max_pool(nodes, (26, 26, 16), (13, 13, 16), (2, 2), 1)
-
-    # layer 2
-    conv(nodes[1], nodes, filters, 2, (13, 13, 16), 1)
-    bias_conv(nodes[2], biases[1])
-    requantize_activations(nodes, 2, Ms[1], True)
-    relu(nodes[2], True)
-    type_cast(nodes, 2)
-
-    # layer 3: max-pool (2x2)
-    max_pool(nodes, (11, 11, 16), (5, 5, 16), (2, 2), 3)
-
-    # flatten
-    flatten(nodes, 3)
-
-    # layer 4
-    mac_fc(nodes[3], nodes[4], weights, 0)
-    bias(nodes[4], biases[2])
-    requantize_activations(nodes, 4, Ms[2], False)
-    relu(nodes[4], False)
-    type_cast(nodes, 4)
-
-    # layer 5
-    mac_fc(nodes[4], nodes[5], weights, 1)
-    bias(nodes[5], biases[3])
-
-    return np.argmax(nodes[-1])
-
-def process_model_cifar(nodes, img, weights, filters, biases, Ms):
-    # layer 0
-    conv(img, nodes, filters, 0, (32, 32, 3), 0)
-    bias_conv(nodes[0], biases[0])
-    requantize_activations(nodes, 0, Ms[0], True)
-    relu(nodes[0], True)
-    type_cast(nodes, 0)
-
-    # layer 1: max-pool (2x2)
-    max_pool(nodes, (30, 30, 16), (15, 15, 16), (2, 2), 1)
-
-    # layer 2
-    conv(nodes[1], nodes, filters, 2, (15, 15, 16), 1)
-    bias_conv(nodes[2], biases[1])
-    requantize_activations(nodes, 2, Ms[1], True)
-    relu(nodes[2], True)
-    type_cast(nodes, 2)
-
-    # layer 3: max-pool (2x2)
-    max_pool(nodes, (13, 13, 16), (6, 6, 16), (2, 2), 3)
-
-    # flatten
-    flatten(nodes, 3)
-
-    # layer 4
-    mac_fc(nodes[3], nodes[4], weights, 0)    
-    bias(nodes[4], biases[2])
-    requantize_activations(nodes, 4, Ms[2], False)
-    relu(nodes[4], False)
-    type_cast(nodes, 4)
-
-    # layer 5
-    mac_fc(nodes[4], nodes[5], weights, 1)
-    bias(nodes[5], biases[3])
-
-    return np.argmax(nodes[-1])
-
-def process_model_cifar_advanced(nodes, img, weights, filters, biases, Ms):
-    # layer 0: conv 3x3
-    conv(img, nodes, filters, 0, (32, 32, 3), 0)
-    bias_conv(nodes[0], biases[0])
-    requantize_activations(nodes, 0, Ms[0], True)
-    relu(nodes[0], True)
-    type_cast(nodes, 0)
-
-    # layer 1: max-pool (2x2)
-    max_pool(nodes, (30, 30, 32), (15, 15, 32), (2, 2), 1)
-
-    # layer 2: conv 3x3
-    conv(nodes[1], nodes, filters, 2, (15, 15, 32), 1)
-    bias_conv(nodes[2], biases[1])
-    requantize_activations(nodes, 2, Ms[1], True)
-    relu(nodes[2], True)
-    type_cast(nodes, 2)
-
-    # layer 3: max-pool (2x2)
-    max_pool(nodes, (13, 13, 64), (6, 6, 64), (2, 2), 3)
-
-    # layer 4: conv 3x3
-    conv(nodes[3], nodes, filters, 4, (4, 4, 64), 2)
-    bias_conv(nodes[4], biases[2])
-    requantize_activations(nodes, 4, Ms[2], True)
-    relu(nodes[4], True)
-    type_cast(nodes, 4)
-
-    # flatten
-    flatten(nodes, 4)
-
-    # layer 5: fc
-    mac_fc(nodes[4], nodes[5], weights, 0)    
-    bias(nodes[5], biases[3])
-    requantize_activations(nodes, 5, Ms[3], False)
-    relu(nodes[5], False)
-    type_cast(nodes, 5)
-
-    # layer 6: fc
-    mac_fc(nodes[5], nodes[6], weights, 1)
-    bias(nodes[6], biases[4])
-
-    return np.argmax(nodes[-1])
+        Ms, finish = plan["Ms"], epilogue
+
+    layer_in = imgs
+
+    for layer, step in enumerate(steps):
+        if step["type"] == "pool":
+            layer_out = get_view(arena["acts"][layer % 2], lead + step["out_shape"])
+            max_pool(layer_in, layer_out, step["p_shape"], step["stride"])
+        else:
+            acc = get_view(arena["acc"], lead + step["out_shape"])
+            kernel = kernels[step["kernel_id"]]
+
+            if step["type"] == "conv":
+                conv(layer_in, kernel, step["f_shape"], acc, arena, step["wrap"])
+            elif step["type"] == "fc":
+                mac_fc(layer_in, kernel, acc, arena, step["wrap"])
+
+            if step["m_id"] is None:
+                layer_out = acc
+                finish(acc, biases[step["bias_id"]], None, None, None)
+            else:
+                layer_out = get_view(arena["acts"][layer % 2], lead + step["out_shape"])
+                finish(acc, biases[step["bias_id"]], Ms[step["m_id"]], layer_out, get_view(arena["prod"], acc.shape))
+
+        if nodes is not None:
+            nodes.append(layer_out.copy())
+
+        layer_in = layer_out
+
+    return layer_in
+
+def predict(output):
+    return np.argmax(output, axis=-1)
+
+def process_batch(plan, imgs, batch_size=BATCH_SIZE, logits=False, arena=None, fixed_point=False):
+    # push a stack of images (N x H x W x C) through the model, batch_size images at a time, reusing a single
+    # arena. Returns the predicted class of every image and, if requested, the output layer of every image as well
+    num_imgs = len(imgs)
+    preds = np.zeros(num_imgs, dtype=np.int64)
+    outputs = np.zeros((num_imgs,) + plan["steps"][-1]["out_shape"], dtype=DTYPE_ACC)
+
+    if arena is None:
+        arena = init_arena(plan, min(batch_size, num_imgs), fixed_point)
+
+    for start in range(0, num_imgs, batch_size):
+        output = run_plan(plan, imgs[start : start + batch_size], arena)
+        preds[start : start + len(output)] = predict(output)
+        outputs[start : start + len(output)] = output
+
+    if logits:
+        return preds, outputs
+    return preds
+
+def dump_layers(plan, imgs, batch_size=BATCH_SIZE, arena=None, fixed_point=False):
+    # run a stack of images through the model and collect the flattened output of every layer, in the format
+    # of compare_output's layer dumps. Returns a dict of (N, nodes) arrays and a dict of layer shapes
+    num_imgs = len(imgs)
+    layers = {}
+
+    if arena is None:
+        arena = init_arena(plan, min(batch_size, num_imgs), fixed_point)
+
+    for start in range(0, num_imgs, batch_size):
+        nodes = []
+        run_plan(plan, imgs[start : start + batch_size], arena, nodes)
+
+        for layer, node in enumerate(nodes):
+            node = node.reshape(len(node), -1)
+            if layer not in layers:
+                layers[layer] = np.zeros((num_imgs, node.shape[1]), dtype=node.dtype)
+            layers[layer][start : start + len(node)] = node
+
+    shapes = {layer: step["out_shape"] for layer, step in enumerate(plan["steps"])}
+
+    return layers, shapes
+
+def share_plan(plan):
+    # copy the parameter arrays of a plan into shared memory. Returns a picklable copy of the plan that holds
+    # (block name, shape, dtype) descriptors instead of arrays, and the blocks themselves. The caller keeps the
+    # blocks alive while workers use them and unlinks them afterwards
+    shared = dict(plan)
+    blocks = []
+
+    for key in PARAM_KEYS:
+        descriptors = []
+        for array in plan[key]:
+            array = np.asarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            blocks.append(block)
+            descriptors.append((block.name, array.shape, array.dtype.str))
+        shared[key] = descriptors
+
+    return shared, blocks
+
+def attach_plan(shared):
+    # inverse of share_plan: map the shared parameter arrays into this process without copying them
+    plan = dict(shared)
+    blocks = []
+
+    for key in PARAM_KEYS:
+        arrays = []
+        for name, shape, dtype in shared[key]:
+            block = shared_memory.SharedMemory(name=name)
+            blocks.append(block)
+            arrays.append(np.ndarray(shape, dtype=dtype, buffer=block.buf))
+        plan[key] = arrays
+
+    return plan, blocks
+
+def init_worker(shared, batch_size, dataset, fixed_point):
+    _worker["plan"], _worker["blocks"] = attach_plan(shared)
+    _worker["arena"] = init_arena(_worker["plan"], batch_size, fixed_point)
+    _worker["batch_size"] = batch_size
+    _worker["dataset"] = dataset
+
+def run_shard(shard):
+    # classify the images [start, stop) of the test set. Every worker maps the cached dataset itself, so only
+    # the index range and the predictions cross process boundaries
+    start, stop = shard
+    test_images, _ = data_loader.load_cached(_worker["dataset"])
+    preds = process_batch(_worker["plan"], test_images[start:stop], _worker["batch_size"], arena=_worker["arena"])
+    return start, preds
+
+def process_parallel(plan, num_imgs, workers, batch_size=BATCH_SIZE, dataset="cifar", fixed_point=False):
+    # shard the first num_imgs test images over a pool of worker processes. Parameters are loaded into shared
+    # memory once instead of being pickled for every worker. Returns the predicted class of every image
+    shared, blocks = share_plan(plan)
+    shard_size = batch_size * BATCHES_PER_SHARD
+    shards = [(start, min(start + shard_size, num_imgs)) for start in range(0, num_imgs, shard_size)]
+    preds = np.zeros(num_imgs, dtype=np.int64)
+
+    try:
+        with Pool(workers, initializer=init_worker, initargs=(shared, batch_size, dataset, fixed_point)) as pool:
+            for start, shard_preds in pool.imap_unordered(run_shard, shards):
+                preds[start : start + len(shard_preds)] = shard_preds
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return preds
+
+def print_report(preds, labels, num_classes, elapsed):
+    # accuracy and confusion matrix (rows: expected class, columns: returned class)
+    confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+    np.add.at(confusion, (labels, preds), 1)
+
+    count = np.trace(confusion)
+    print(f"{100 * count / len(preds)}% correct ({len(preds)} images in {elapsed:.1f}s, {len(preds) / elapsed:.1f} images/s).")
+    print("confusion matrix (expected x returned):")
+    print(confusion)
 
 def print_nodes(nodes, layer, num_nodes, offset):
     if len(nodes[layer].shape) > 1:
@@ -447,43 +519,16 @@ def print_nodes(nodes, layer, num_nodes, offset):
 if __name__ == "__main__":
     args = parse_args()
 
+    import tensorflow as tf
+
     interpreter = tf.lite.Interpreter(model_path=args["model"])
     interpreter.allocate_tensors()
 
-    tensor_details = interpreter.get_tensor_details()
-    layers = {}
-
-    for dict in tensor_details:
-        layers[dict["index"]] = {"name": dict["name"], "tensor": interpreter.tensor(dict["index"])(), "qp": dict["quantization_parameters"]}
-
-    fcs, bas, convs = get_layer_ids(layers)
-    Ms = find_ms(layers)
-    nodes = init_nodes(bas, layers)
+    plan = build_plan(interpreter)
     img, label = load_input(args["image"], "cifar")
-    weights = load_weights(fcs, layers)
-    biases = load_biases(bas, layers)
-    filters = load_filters(convs, layers)
-
-    if args["type"] == "basic_fc":
-        process = process_model_basic_fc
-    elif args["type"] == "three_fc":
-        process = process_model_three_fc
-    elif args["type"] == "basic_conv":
-        process = process_model_basic_conv
-    elif args["type"] == "min_conv":
-        process = process_model_conv_minimal
-    elif args["type"] == "min_pool":
-        process = process_model_min_pool
-    elif args["type"] == "cifar":
-        process = process_model_cifar
-    elif args["type"] == "cifar_advanced":
-        process = process_model_cifar_advanced
-    else:
-        print("unknown model architecture descriptor. Exiting...")
-        sys.exit(0)
-
 
-    res = process(nodes, img, weights, filters, biases, Ms)
+    nodes = []
+    res = predict(run_plan(plan, img, nodes=nodes, fixed_point=args["fixed_point"]))
     print("========= inference result of image " + str(args["image"]) + " =========")
     print(f"EXPECTED {label}, RETURNED {res}")
 
@@ -498,11 +543,50 @@ if __name__ == "__main__":
 
         for i in range(num):
             inp, label = load_input(i, "cifar")
-            nodes = init_nodes(bas, layers)
-            res = process(nodes, inp, weights, filters, biases, Ms)
+            res = predict(run_plan(plan, inp, fixed_point=args["fixed_point"]))
 
             print(f"EXPECTED {label}, RETURNED {res}")
             if res == label:
                 count += 1
 
         print(f"{100 * count / num}% correct.")
+
+    if args["full"]:
+        print("========= full test set ============")
+        test_images, test_labels = data_loader.load_cached("cifar")
+        num_classes = plan["steps"][-1]["out_shape"][-1]
+
+        if args["workers"] > 1:
+            t0 = time.perf_counter()
+            preds = process_parallel(
+                plan, len(test_images), args["workers"], args["batch_size"], fixed_point=args["fixed_point"]
+            )
+            t1 = time.perf_counter()
+
+            print_report(preds, test_labels, num_classes, t1 - t0)
+            print(f"{args['workers']} workers")
+        else:
+            tracemalloc.start()
+            arena = init_arena(plan, args["batch_size"], args["fixed_point"])
+
+            t0 = time.perf_counter()
+            preds = process_batch(plan, test_images, args["batch_size"], arena=arena)
+            t1 = time.perf_counter()
+
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print_report(preds, test_labels, num_classes, t1 - t0)
+            print(f"arena: {arena_bytes(arena) / 2**20:.1f} MB, peak memory: {peak / 2**20:.1f} MB")
+
+    if args["dump"]:
+        print("========= layer dump ============")
+        test_images, _ = data_loader.load_cached("cifar")
+        stop = min(args["image"] + args["num_images"], len(test_images))
+        images = np.arange(args["image"], stop)
+
+        layers, shapes = dump_layers(
+            plan, test_images[args["image"] : stop], args["batch_size"], fixed_point=args["fixed_point"]
+        )
+        compare_output.save_dump(args["dump"], images, layers, shapes)
+        print(f"{len(layers)} layers of images {args['image']} to {stop - 1} written to {args['dump']}")
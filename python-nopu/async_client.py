@@ -0,0 +1,340 @@
+import asyncio
+import os
+import sys
+import time
+from collections import deque
+
+from latency import init_phases, print_summary, record
+from protocol import (
+    ALL_BATS,
+    HOST_IP,
+    MAX_SILENCE,
+    MAX_TRIES,
+    NUM_BAT,
+    NUM_RES,
+    NUM_SEQ,
+    PORT,
+    RES_SIZE,
+    RESET,
+    RESET_SIZE,
+    SACK_SIZE,
+    TARGET_IP,
+    TIMEOUT,
+    InferenceTimeout,
+    init_rto,
+    init_stats,
+    make_chunks,
+    missing,
+    next_timeout,
+    rto_backoff,
+    rto_sample,
+    silence_limit,
+)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../model_prep/src"))
+import data_loader
+
+# requests a client accepts at once. Every request holds a SEQ while it is in flight, so this stays below NUM_SEQ
+MAX_IN_FLIGHT = 64
+# images on the board at once: one being classified and the next one being loaded into the other image buffer. Only
+# one image is transferred at a time, since the firmware receives one image at a time. Images count as on the board
+# until they and all images sent before them are done, so the board still keeps any result the client may ask for
+# again
+BOARD_DEPTH = 2
+
+
+# asyncio client for the windowed protocol of hardware_test.c. Any number of coroutines can await infer() at the same
+# time: up to max_in_flight requests get a SEQ and wait for the board, depth of them are sent to it one after the
+# other, so that the next image is transferred while the board classifies the previous one, and responses are
+# matched to requests by SEQ. A request is cancelled like any other coroutine, and its late responses are dropped.
+# Retry timeouts follow the round trips measured by the client and back off exponentially. Before the first request,
+# the client resets the board, so that results kept from earlier sessions are not taken for its own
+class InferenceClient(asyncio.DatagramProtocol):
+    def __init__(
+        self,
+        target=(TARGET_IP, PORT),
+        max_in_flight=MAX_IN_FLIGHT,
+        depth=BOARD_DEPTH,
+        max_tries=MAX_TRIES,
+    ):
+        if not 0 < max_in_flight < NUM_SEQ:
+            raise ValueError(f"max_in_flight must be between 1 and {NUM_SEQ - 1}")
+        if not 0 < depth <= NUM_RES:
+            raise ValueError(f"depth must be between 1 and {NUM_RES}")
+
+        self.target = target
+        self.max_tries = max_tries
+        self.transport = None
+        self.closed = None
+        self.seq = 0
+        # SEQ -> request dict of the requests in flight
+        self.pending = {}
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.depth = depth
+        # requests on the board, in the order they were sent
+        self.on_board = deque()
+        self.board = asyncio.Condition()
+        # arrival of the last result in ns. The board classifies in order, so it starts an image once that image is
+        # sent and the result of the one before it is out
+        self.t_result = 0
+        # held while the chunks of an image are not all acknowledged
+        self.link = asyncio.Lock()
+        # the board was reset for this client, see reset()
+        self.session = False
+        self.session_lock = asyncio.Lock()
+        self.reset_ack = None
+        # round trip estimators for chunk to ACK and for last ACK to result, which includes the inference
+        self.rto = {"ack": init_rto(), "result": init_rto()}
+        self.stats = init_stats()
+        self.latency = init_phases()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        if len(data) == RESET_SIZE:
+            if self.reset_ack is not None and not self.reset_ack.done():
+                self.reset_ack.set_result(True)
+            return
+        if len(data) not in (SACK_SIZE, RES_SIZE):
+            return
+
+        # responses to finished or cancelled requests are stale
+        req = self.pending.get(data[0])
+        if req is None:
+            return
+
+        # by Karn's rule, round trips involving a resend are not measured
+        now = time.perf_counter_ns()
+        if len(data) == SACK_SIZE:
+            bat = data[1]
+            if not (req["resent"] | req["acked"]) & (1 << bat):
+                record(self.latency["ack"], now - req["t_chunk"][bat])
+                rto_sample(self.rto["ack"], (now - req["t_chunk"][bat]) / 1e9)
+            req["acked"] |= 1 << bat
+            if req["mask"] != ALL_BATS and req["mask"] | data[2] == ALL_BATS:
+                req["t_acked"] = now
+            req["mask"] |= data[2]
+            # the ACK of the last chunk acts as NACK for the chunks missing in its mask
+            if bat == NUM_BAT - 1 and req["mask"] != ALL_BATS:
+                self.resend(req)
+        elif not req["result"].done():
+            self.resend_lost(req)
+            if req["mask"] == ALL_BATS:
+                record(self.latency["result"], now - req["t_acked"])
+                if not req["result_resent"]:
+                    rto_sample(self.rto["result"], (now - req["t_acked"]) / 1e9)
+            if req["t_resent"]:
+                record(self.latency["retry"], now - req["t_resent"])
+            record(self.latency["service"], now - max(req["t_sent"], self.t_result))
+            self.t_result = now
+            record(self.latency["total"], now - req["t_start"])
+            req["result"].set_result(int(data[1]))
+
+        if req["progress"] is not None and not req["progress"].done():
+            req["progress"].set_result(True)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable. The requests notice through their retry timeouts
+        pass
+
+    def connection_lost(self, exc):
+        for req in self.pending.values():
+            if not req["result"].done():
+                req["result"].set_exception(exc or ConnectionError("client closed"))
+
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(None)
+
+    def next_seq(self):
+        # the next SEQ not held by a request in flight. There is always one, since max_in_flight < NUM_SEQ
+        while True:
+            self.seq = (self.seq + 1) % NUM_SEQ
+            if self.seq not in self.pending:
+                return self.seq
+
+    def send_chunks(self, req, bats):
+        now = time.perf_counter_ns()
+        for bat in bats:
+            self.transport.sendto(req["chunks"][bat], self.target)
+            req["t_chunk"][bat] = now
+
+    def resend(self, req):
+        # resend the chunks not acknowledged yet, or the last one to get a lost result repeated
+        bats = [NUM_BAT - 1] if req["mask"] == ALL_BATS else missing(req["mask"])
+        req["result_resent"] = req["mask"] == ALL_BATS
+        self.send_chunks(req, bats)
+        req["resent"] |= sum(1 << bat for bat in bats)
+        req["t_resent"] = req["t_resent"] or req["t_chunk"][bats[0]]
+        self.stats["retries"] += len(bats)
+
+    def resend_lost(self, req):
+        # the board answers in order, so the results of the images sent before req that are not done were lost
+        for other in self.on_board:
+            if other is req:
+                break
+            if other["mask"] == ALL_BATS and not other["result"].done() and not other["result_resent"]:
+                self.resend(other)
+
+    async def infer(self, img, timeout=None, t_start=None):
+        # classify a single image (32 x 32 x 3 uint8). Raises InferenceTimeout if the board does not answer within
+        # max_tries retry timeouts or the silence limit, or TimeoutError if the whole request including queueing
+        # takes longer than timeout seconds. t_start is the time of the request in perf_counter_ns if it was made
+        # before the call, e.g. the scheduled arrival of a load generator, so that the queue and total latency
+        # include any delay until then
+        if self.transport is None or self.transport.is_closing():
+            raise ConnectionError("client is not connected")
+
+        async with self.slots:
+            seq = self.next_seq()
+            req = {
+                "chunks": make_chunks(img, seq),
+                "mask": 0,
+                # request, first send, last send of every chunk, first resend and completion of the mask in ns
+                "t_start": t_start or time.perf_counter_ns(),
+                "t_sent": None,
+                "t_chunk": [None] * NUM_BAT,
+                "t_resent": None,
+                "t_acked": None,
+                # chunks sent more than once and ACKed so far
+                "resent": 0,
+                "acked": 0,
+                "result_resent": False,
+                "finished": False,
+                "progress": None,
+                "result": asyncio.get_running_loop().create_future(),
+            }
+            self.pending[seq] = req
+            self.stats["requests"] += 1
+
+            try:
+                return await asyncio.wait_for(self.transfer(req), timeout)
+            except (InferenceTimeout, asyncio.TimeoutError):
+                self.stats["failed"] += 1
+                raise
+            finally:
+                del self.pending[seq]
+
+    async def reset(self):
+        # start a session on the board, see protocol.py. Requests wait for the first reset to finish. Raises
+        # InferenceTimeout if the board does not answer within MAX_SILENCE
+        async with self.session_lock:
+            if self.session:
+                return
+
+            loop = asyncio.get_running_loop()
+            tries = round(MAX_SILENCE / TIMEOUT)
+            for _ in range(tries):
+                self.reset_ack = ack = loop.create_future()
+                timer = loop.call_later(TIMEOUT, lambda: ack.done() or ack.set_result(False))
+                self.transport.sendto(bytes([RESET]), self.target)
+
+                try:
+                    self.session = await ack
+                finally:
+                    timer.cancel()
+                if self.session:
+                    return
+                self.stats["timeouts"] += 1
+
+            raise InferenceTimeout(f"no answer to reset from {self.target[0]} after {tries} tries")
+
+    async def transfer(self, req):
+        # send the image and wait for its result. The link is passed on to the next image once all chunks are
+        # acknowledged, while this one is classified
+        await self.reset()
+        async with self.board:
+            await self.board.wait_for(lambda: len(self.on_board) < self.depth)
+            self.on_board.append(req)
+
+        try:
+            async with self.link:
+                self.send_chunks(req, range(NUM_BAT))
+                req["t_sent"] = req["t_chunk"][0]
+                record(self.latency["queue"], req["t_sent"] - req["t_start"])
+                tries = await self.retry(req, lambda: req["mask"] == ALL_BATS or req["result"].done())
+
+            await self.retry(req, req["result"].done, tries)
+            return req["result"].result()
+        finally:
+            await self.leave_board(req)
+
+    async def leave_board(self, req):
+        # requests leave the board in order, once they and all requests sent before them are done
+        async with self.board:
+            req["finished"] = True
+            while self.on_board and self.on_board[0]["finished"]:
+                self.on_board.popleft()
+            self.board.notify_all()
+
+    async def retry(self, req, done, tries=0):
+        # wait until done(). Chunks not acknowledged within a retry timeout are resent. Once all chunks are
+        # acknowledged, resending one makes the board repeat a lost result. Fails after max_tries timeouts, or once
+        # the board was silent for longer than silence_limit. Returns the number of tries so far
+        heard = time.perf_counter()
+        while not done():
+            est = self.rto["ack"] if req["mask"] != ALL_BATS else self.rto["result"]
+            if await self.wait_progress(req, next_timeout(est, time.perf_counter() - heard)):
+                heard = time.perf_counter()
+                continue
+
+            tries += 1
+            self.stats["timeouts"] += 1
+            rto_backoff(est)
+            if tries >= self.max_tries or time.perf_counter() - heard >= silence_limit(est):
+                raise InferenceTimeout(f"no response to SEQ {req['chunks'][0][0]} after {tries} tries")
+
+            self.resend(req)
+
+        return tries
+
+    async def wait_progress(self, req, timeout):
+        # wait for the next response to a request. Returns False after timeout seconds without one. A plain future
+        # with a timer instead of a nested wait_for, so that cancelling the request always propagates
+        loop = asyncio.get_running_loop()
+        req["progress"] = progress = loop.create_future()
+        timer = loop.call_later(timeout, lambda: progress.done() or progress.set_result(False))
+
+        try:
+            return await progress
+        finally:
+            timer.cancel()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+        await self.closed
+
+
+async def open_client(local=(HOST_IP, PORT), **kwargs):
+    # create a client bound to the local address. Usable as async context manager, which closes it on exit
+    loop = asyncio.get_running_loop()
+    _, client = await loop.create_datagram_endpoint(lambda: InferenceClient(**kwargs), local_addr=local)
+    return client
+
+
+async def main():
+    test_images, test_labels = data_loader.load_cached("cifar")
+    num = 100
+
+    async with await open_client() as client:
+        t0 = time.perf_counter()
+        res = await asyncio.gather(*[client.infer(test_images[i]) for i in range(num)])
+        t1 = time.perf_counter()
+
+    correct = sum(int(r == int(label)) for r, label in zip(res, test_labels[:num]))
+    print(f"accuracy: {correct / num}")
+    print(f"{num} images in {t1 - t0:.2f}s ({num / (t1 - t0):.1f} images/s)")
+    print(f"{client.stats['retries']} chunks resent, {client.stats['timeouts']} timeouts")
+    print_summary(client.latency)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
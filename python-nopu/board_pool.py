@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import time
+
+from async_client import BOARD_DEPTH, InferenceClient
+from protocol import HOST_IP, PORT, InferenceError, InferenceTimeout
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../model_prep/src"))
+import data_loader
+
+# images the pool hands to a board at once: one being classified, one being loaded to follow right away. The rest
+# wait in the pool, so that they go to whichever board frees up first
+BOARD_QUEUE = BOARD_DEPTH
+# seconds a board stays out of rotation after a request to it timed out
+DOWN_TIME = 5
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("boards", nargs="+", help="boards as ip or ip:port, e.g. 127.0.0.2:5006 127.0.0.2:5007")
+    parser.add_argument("--host", default=HOST_IP, help="local address to bind to")
+    parser.add_argument("--port", type=int, default=PORT, help="local port to bind to, shared by all boards")
+    parser.add_argument("-n", "--num_images", type=int, default=1000, help="number of test images to classify")
+
+    return vars(parser.parse_args())
+
+
+def parse_board(board):
+    ip, _, port = board.partition(":")
+    return ip, int(port) if port else PORT
+
+
+# client for several boards. Every board has its own InferenceClient on its own socket. Images go to the board with
+# the fewest images in flight. A board that times out is taken out of rotation for DOWN_TIME seconds, and its images
+# are retried on other boards
+class BoardPool:
+    def __init__(self, clients, queue=BOARD_QUEUE, down_time=DOWN_TIME):
+        self.boards = [
+            {"client": client, "tasks": set(), "in_flight": 0, "images": 0, "failed": 0, "busy": 0.0, "down_until": 0.0}
+            for client in clients
+        ]
+        # requests cancelled because their board went down
+        self.evicted = set()
+        self.queue = queue
+        self.down_time = down_time
+        self.changed = asyncio.Condition()
+        self.start = time.perf_counter()
+
+    def pick(self, exclude):
+        # least loaded board that is up and has room. If every candidate is down, the one back soonest is probed
+        now = time.perf_counter()
+        candidates = [b for i, b in enumerate(self.boards) if i not in exclude]
+        up = [b for b in candidates if b["down_until"] <= now]
+
+        if not up:
+            up = [min(candidates, key=lambda b: b["down_until"])]
+        free = [b for b in up if b["in_flight"] < self.queue]
+
+        if not free:
+            return None
+        return min(free, key=lambda b: (b["in_flight"], b["images"]))
+
+    async def acquire(self, exclude):
+        async with self.changed:
+            while True:
+                board = self.pick(exclude)
+                if board is not None:
+                    board["in_flight"] += 1
+                    return board
+                await self.changed.wait()
+
+    async def release(self, board):
+        async with self.changed:
+            board["in_flight"] -= 1
+            self.changed.notify_all()
+
+    def take_down(self, board):
+        # take a board out of rotation and move the images waiting for it to other boards
+        board["down_until"] = time.perf_counter() + self.down_time
+        for task in board["tasks"]:
+            if not task.done():
+                self.evicted.add(task)
+                task.cancel()
+
+    async def infer(self, img):
+        # classify a single image on any board. Raises the error of the last board tried if none answers
+        tried = set()
+
+        while True:
+            board = await self.acquire(tried)
+            tried.add(self.boards.index(board))
+            t0 = time.perf_counter()
+            task = asyncio.ensure_future(board["client"].infer(img))
+            board["tasks"].add(task)
+
+            try:
+                res = await task
+                board["images"] += 1
+                board["busy"] += time.perf_counter() - t0
+                return res
+            except InferenceTimeout:
+                board["failed"] += 1
+                self.take_down(board)
+                if len(tried) == len(self.boards):
+                    raise
+            except asyncio.CancelledError:
+                # the request was evicted from a board that went down, unless the caller cancelled it
+                if task not in self.evicted:
+                    raise
+                self.evicted.discard(task)
+                if len(tried) == len(self.boards):
+                    raise InferenceTimeout(f"board {board['client'].target} went down")
+            finally:
+                board["tasks"].discard(task)
+                await self.release(board)
+
+    def report(self):
+        # per board: target, images classified, failed requests, whether it is in rotation, images per second since
+        # the pool was created and seconds per image including queueing
+        elapsed = time.perf_counter() - self.start
+        now = time.perf_counter()
+
+        return [
+            {
+                "target": b["client"].target,
+                "images": b["images"],
+                "failed": b["failed"],
+                "up": b["down_until"] <= now,
+                "throughput": b["images"] / elapsed,
+                "latency": b["busy"] / max(b["images"], 1),
+            }
+            for b in self.boards
+        ]
+
+    def close(self):
+        for b in self.boards:
+            b["client"].close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+        for b in self.boards:
+            await b["client"].closed
+
+
+def make_socket(local, target):
+    # a UDP socket bound to the local address and connected to a board. The firmware always answers to port PORT of
+    # the host, so the sockets of all boards share it and the kernel hands each one the packets of its board
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(local)
+    sock.connect(target)
+    return sock
+
+
+async def open_pool(targets, local=(HOST_IP, PORT), queue=BOARD_QUEUE, down_time=DOWN_TIME, **kwargs):
+    # create a pool with a client per board in targets, a list of (ip, port). kwargs go to every InferenceClient.
+    # Usable as async context manager, which closes all clients on exit
+    loop = asyncio.get_running_loop()
+    clients = []
+
+    for target in targets:
+        sock = make_socket(local, target)
+        _, client = await loop.create_datagram_endpoint(lambda: InferenceClient(target, **kwargs), sock=sock)
+        clients.append(client)
+
+    return BoardPool(clients, queue, down_time)
+
+
+def print_report(pool):
+    total = 0
+    for b in pool.report():
+        ip, port = b["target"]
+        state = "up" if b["up"] else "down"
+        print(
+            f"{ip}:{port} ({state}): {b['images']} images, {b['failed']} failed, "
+            f"{b['throughput']:.1f} images/s, {1000 * b['latency']:.2f} ms per image"
+        )
+        total += b["throughput"]
+
+    print(f"total: {total:.1f} images/s")
+
+
+async def main(args):
+    test_images, test_labels = data_loader.load_cached("cifar")
+    num = args["num_images"]
+    targets = [parse_board(b) for b in args["boards"]]
+
+    async with await open_pool(targets, (args["host"], args["port"])) as pool:
+        res = await asyncio.gather(*[pool.infer(test_images[i]) for i in range(num)], return_exceptions=True)
+        print_report(pool)
+
+    failed = sum(isinstance(r, InferenceError) for r in res)
+    correct = sum(int(r == int(label)) for r, label in zip(res, test_labels[:num]))
+    print(f"accuracy: {correct / num}, {failed} images failed")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,219 @@
+import csv
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from protocol import InferenceError
+
+# bulk inference: stream images from a .npy file (memory mapped), a directory of image files or stdin (raw 32x32x3
+# uint8 images back to back), classify them block by block and append the results to a CSV file or to a directory
+# of Parquet files as they come. After every CHECKPOINT_INTERVAL images, the output is synced to disk and the
+# number of images done is written to <output>.ckpt, so an interrupted job resumes from there with --resume. Only
+# the results since the last checkpoint are held in memory
+
+IMG_SHAPE = (32, 32, 3)
+IMG_SIZE = int(np.prod(IMG_SHAPE))
+CHECKPOINT_INTERVAL = 1000
+IMG_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".ppm")
+COLUMNS = ["index", "id", "class", "time_ms", "cycles", "error"]
+
+
+def read_npy(path, start, block):
+    # blocks of (ids, images) from an (N, 32, 32, 3) uint8 .npy file, without loading it
+    images = np.load(path, mmap_mode="r")
+    if images.shape[1:] != IMG_SHAPE or images.dtype != np.uint8:
+        raise ValueError(f"{path} holds {images.dtype} images of shape {images.shape[1:]}, expected uint8 {IMG_SHAPE}")
+
+    for i in range(start, len(images), block):
+        yield [str(j) for j in range(i, min(i + block, len(images)))], images[i : i + block]
+
+
+def read_dir(path, start, block):
+    # blocks of (file names, images) from the image files of a directory, in sorted order. Images are converted to
+    # RGB and scaled to 32 x 32 if needed
+    import cv2
+
+    names = sorted(f for f in os.listdir(path) if f.lower().endswith(IMG_EXTENSIONS))
+
+    for i in range(start, len(names), block):
+        ids = names[i : i + block]
+        images = np.empty((len(ids), *IMG_SHAPE), dtype=np.uint8)
+
+        for j, name in enumerate(ids):
+            img = cv2.imread(os.path.join(path, name), cv2.IMREAD_COLOR)
+            if img is None:
+                raise ValueError(f"can't read image {name}")
+            if img.shape[:2] != IMG_SHAPE[:2]:
+                img = cv2.resize(img, IMG_SHAPE[1::-1], interpolation=cv2.INTER_AREA)
+            images[j] = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+        yield ids, images
+
+
+def read_stream(f, start, block):
+    # blocks of (ids, images) from a binary stream of raw images. The first start images are skipped
+    for _ in range(start):
+        if len(f.read(IMG_SIZE)) < IMG_SIZE:
+            return
+
+    i = start
+    while True:
+        data = f.read(IMG_SIZE * block)
+        n = len(data) // IMG_SIZE
+        if n == 0:
+            return
+
+        images = np.frombuffer(data, dtype=np.uint8, count=n * IMG_SIZE).reshape(n, *IMG_SHAPE)
+        yield [str(j) for j in range(i, i + n)], images
+        i += n
+
+
+def open_source(path, start=0, block=1):
+    # blocks of (ids, images) from path: "-" for stdin, a directory or a .npy file
+    if path == "-":
+        return read_stream(sys.stdin.buffer, start, block)
+    if os.path.isdir(path):
+        return read_dir(path, start, block)
+    return read_npy(path, start, block)
+
+
+# results as CSV, one row per image. Rows are appended as they come; a checkpoint records the size of the file, so
+# rows written after it are cut off on resume
+class CsvSink:
+    def __init__(self, path, offset=None):
+        if offset is None:
+            self.f = open(path, "w", newline="")
+            csv.writer(self.f).writerow(COLUMNS)
+        else:
+            self.f = open(path, "r+", newline="")
+            self.f.truncate(offset)
+            self.f.seek(offset)
+        self.writer = csv.writer(self.f)
+
+    def write(self, rows):
+        self.writer.writerows(zip(*(rows[c] for c in COLUMNS)))
+        self.f.flush()
+
+    def checkpoint(self):
+        os.fsync(self.f.fileno())
+        return {"offset": self.f.tell()}
+
+    def close(self):
+        self.f.close()
+
+
+# results as a directory of Parquet files, one per checkpoint. Rows are collected until the next checkpoint; part
+# files without a checkpoint are overwritten on resume
+class ParquetSink:
+    def __init__(self, path, parts=None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow, use a .csv output instead")
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.parts = parts or 0
+        self.rows = {c: [] for c in COLUMNS}
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, rows):
+        for c in COLUMNS:
+            self.rows[c].extend(rows[c])
+
+    def checkpoint(self):
+        if self.rows["index"]:
+            part = os.path.join(self.path, f"part-{self.parts:05d}.parquet")
+            self.pq.write_table(self.pa.table(self.rows), part + ".tmp")
+            os.replace(part + ".tmp", part)
+            self.parts += 1
+            self.rows = {c: [] for c in COLUMNS}
+        return {"parts": self.parts}
+
+    def close(self):
+        pass
+
+
+def checkpoint_path(output):
+    return output.rstrip("/") + ".ckpt"
+
+
+def load_checkpoint(output):
+    path = checkpoint_path(output)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(output, state):
+    # replace the checkpoint atomically, so a crash leaves either the old or the new one
+    path = checkpoint_path(output)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def open_sink(output, state=None):
+    if output.endswith(".csv"):
+        return CsvSink(output, None if state is None else state["offset"])
+    return ParquetSink(output, None if state is None else state["parts"])
+
+
+def run(classify, source, output, block=1, resume=False, interval=CHECKPOINT_INTERVAL, verbose=False):
+    # classify all images of source block by block and stream the results to output. classify takes an array of
+    # images and returns their classes and cycle counts (or None). Images of blocks that fail are recorded with
+    # class -1 and the error. Returns the number of images done
+    state = load_checkpoint(output) if resume else None
+    if state is not None and state["input"] != os.path.abspath(source):
+        raise ValueError(f"{checkpoint_path(output)} belongs to {state['input']}, not {source}")
+
+    done = 0 if state is None else state["done"]
+    sink = open_sink(output, state)
+    first = last = done
+    t_start = time.perf_counter()
+
+    if state is not None:
+        print(f"resuming after {done} images")
+
+    try:
+        for ids, imgs in open_source(source, done, block):
+            t0 = time.perf_counter()
+            error = ""
+            try:
+                classes, cycles = classify(imgs)
+            except InferenceError as e:
+                classes, cycles, error = np.full(len(imgs), -1), None, str(e)
+            dt = 1000 * (time.perf_counter() - t0) / len(imgs)
+
+            sink.write(
+                {
+                    "index": range(done, done + len(imgs)),
+                    "id": ids,
+                    "class": [int(c) for c in classes],
+                    "time_ms": [round(dt, 3)] * len(imgs),
+                    "cycles": [None] * len(imgs) if cycles is None else [int(c) for c in cycles],
+                    "error": [error] * len(imgs),
+                }
+            )
+            done += len(imgs)
+
+            if done - last >= interval:
+                save_checkpoint(output, {"input": os.path.abspath(source), "done": done, **sink.checkpoint()})
+                last = done
+                if verbose:
+                    print(f"{done} images, {(done - first) / (time.perf_counter() - t_start):.1f} images/s")
+
+        save_checkpoint(output, {"input": os.path.abspath(source), "done": done, **sink.checkpoint()})
+    finally:
+        sink.close()
+
+    return done
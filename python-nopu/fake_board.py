@@ -0,0 +1,356 @@
+import argparse
+import os
+import random
+import socket
+import sys
+import time
+from collections import deque
+
+import numpy as np
+
+from protocol import (
+    ALL_BATS,
+    BATCH_CYCLES,
+    BATCH_HEADER_SIZE,
+    BATCH_RES,
+    HEADER_SIZE,
+    MAX_BATCH_IMGS,
+    NUM_BAT,
+    NUM_RES,
+    NUM_SEQ,
+    PACKET_SIZE,
+    PORT,
+    RESET,
+    RESET_SIZE,
+)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../model_prep/src"))
+import perf_model
+import simulator
+
+# stand-in for the board running hardware_test.c. Speaks the same UDP protocol (stop-and-wait, windowed and batch) and
+# classifies images with the simulator in fixed-point mode, which is bit-exact with the accelerator. Like the
+# firmware, it receives the next windowed image while the previous one is classified. Run it on a loopback address
+# and point the clients at it, e.g.
+#   python fake_board.py --ip 127.0.0.2 --loss 0.05
+#   python run_inf.py --target 127.0.0.2 --host 127.0.0.1
+
+IMG_SHAPE = (32, 32, 3)
+# seconds to wait for packets before releasing a held back (reordered) packet
+IDLE_TIMEOUT = 0.05
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ip", default="127.0.0.2", help="address to listen on")
+    parser.add_argument("--port", type=int, default=PORT, help="UDP port to listen on")
+    parser.add_argument(
+        "-m",
+        "--model",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "../model_prep/models/8x32_model_qat.tflite"),
+        help="tflite model to classify with",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=-1,
+        help="seconds from the last chunk of an image to its result. Default: modelled from perf_model at 80 MHz",
+    )
+    parser.add_argument("--loss", type=float, default=0, help="probability of dropping a packet, in either direction")
+    parser.add_argument(
+        "--reorder",
+        type=float,
+        default=0,
+        help="probability of holding back an outgoing packet until after the next one",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed for loss and reordering")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every image")
+
+    return vars(parser.parse_args())
+
+
+def init_board(plan, sock, latency, loss=0, reorder=0, seed=0, cycles=0):
+    # state of hardware_test.c, plus the simulator and the fault injection settings. cycles is reported as the cycle
+    # count of every inference in batch mode
+    return {
+        "plan": plan,
+        "arena": simulator.init_arena(plan, 1, fixed_point=True),
+        "sock": sock,
+        "latency": latency,
+        "loss": loss,
+        "reorder": reorder,
+        "rng": random.Random(seed),
+        "held": None,
+        "img": np.zeros(np.prod(IMG_SHAPE), dtype=np.uint8),
+        "seq": 0,
+        "bat": 0,
+        "bat_mask": 0,
+        "windowed": False,
+        # (SEQ, class) of the last NUM_RES windowed images or (SEQ, None) of the last batch, to be sent again
+        "results": deque(maxlen=NUM_RES),
+        # inference in progress: its SEQ, mode, result, when it is done and where to send the result
+        "busy": None,
+        "count": 0,
+        "cycles": cycles,
+        "batch_size": 0,
+        "batch_cycles": False,
+        "batch_masks": np.zeros(MAX_BATCH_IMGS, dtype=np.uint8),
+        "batch_px": np.zeros((MAX_BATCH_IMGS, np.prod(IMG_SHAPE)), dtype=np.uint8),
+        "batch_res": np.zeros(MAX_BATCH_IMGS, dtype=np.uint8),
+    }
+
+
+def transmit(board, msg, addr):
+    # send a packet, subject to loss and reordering. A held back packet goes out right after the next one
+    if board["rng"].random() < board["loss"]:
+        return
+
+    if board["held"] is None and board["rng"].random() < board["reorder"]:
+        board["held"] = (bytes(msg), addr)
+        return
+
+    board["sock"].sendto(bytes(msg), addr)
+    flush(board)
+
+
+def flush(board):
+    if board["held"] is not None:
+        board["sock"].sendto(*board["held"])
+        board["held"] = None
+
+
+def batch_result(board):
+    k = board["batch_size"]
+    msg = [board["seq"], BATCH_RES, k | (BATCH_CYCLES if board["batch_cycles"] else 0)]
+    msg = bytes(msg) + board["batch_res"][:k].tobytes()
+    if board["batch_cycles"]:
+        msg += np.full(k, board["cycles"], dtype=">u4").tobytes()
+    return msg
+
+
+def find_res(board, seq):
+    for res in board["results"]:
+        if res[0] == seq:
+            return res
+    return None
+
+
+def send_last_res(board, res, addr):
+    if board["batch_size"]:
+        transmit(board, batch_result(board), addr)
+    else:
+        transmit(board, res, addr)
+
+
+def receive_batch_chunk(board, data, addr):
+    # same as receive_batch_chunk in hardware_test.c. Returns true when all images of the batch are complete
+    seq, k, idx, bat = data[0], data[1] & ~BATCH_CYCLES, data[2], data[3]
+
+    if k == 0 or k > MAX_BATCH_IMGS or idx >= k or bat >= NUM_BAT:
+        print("Invalid chunk.")
+        return False
+
+    res = find_res(board, seq)
+    if res is not None:
+        send_last_res(board, res, addr)
+        return False
+
+    masks = board["batch_masks"]
+    if not board["batch_size"] or seq != board["seq"]:
+        masks[:] = 0
+    board["windowed"] = True
+    board["results"].clear()
+    board["seq"] = seq
+    board["batch_size"] = k
+    board["batch_cycles"] = bool(data[1] & BATCH_CYCLES)
+
+    if not masks[idx] & (1 << bat):
+        pixels = np.frombuffer(data, np.uint8, offset=BATCH_HEADER_SIZE)
+        board["batch_px"][idx, bat * PACKET_SIZE : (bat + 1) * PACKET_SIZE] = pixels
+        masks[idx] |= 1 << bat
+    transmit(board, [seq, idx, bat, masks[idx]], addr)
+
+    return bool((masks[:k] == ALL_BATS).all())
+
+
+def reset_session(board, addr):
+    # same as reset_session in hardware_test.c: forget the results and the inference of the previous host session
+    board["busy"] = None
+    board["results"].clear()
+    board["seq"] = 0
+    board["bat"] = 0
+    board["bat_mask"] = 0
+    board["windowed"] = False
+    board["batch_size"] = 0
+    board["batch_masks"][:] = 0
+    transmit(board, [RESET], addr)
+
+
+def receive_chunk(board, data, addr):
+    # same as receive_chunk in hardware_test.c. Returns true when the image is complete
+    if len(data) == RESET_SIZE and data[0] == RESET:
+        reset_session(board, addr)
+        return False
+
+    if len(data) == PACKET_SIZE + BATCH_HEADER_SIZE:
+        return receive_batch_chunk(board, data, addr)
+
+    if len(data) == PACKET_SIZE:
+        board["windowed"] = False
+        board["results"].clear()
+        board["batch_size"] = 0
+        board["img"][board["bat"] * PACKET_SIZE : (board["bat"] + 1) * PACKET_SIZE] = np.frombuffer(data, np.uint8)
+        board["bat"] += 1
+        transmit(board, [board["seq"], board["bat"]], addr)
+        return board["bat"] == NUM_BAT
+
+    if len(data) != PACKET_SIZE + HEADER_SIZE or data[1] >= NUM_BAT:
+        print("Invalid chunk.")
+        return False
+
+    seq, bat = data[0], data[1]
+
+    res = find_res(board, seq)
+    if res is not None:
+        send_last_res(board, res, addr)
+        return False
+
+    busy = board["busy"]
+    if busy is not None and seq == busy["seq"]:
+        transmit(board, [seq, bat, ALL_BATS], addr)
+        return False
+
+    if not board["windowed"] or board["batch_size"] or seq != board["seq"]:
+        board["bat_mask"] = 0
+    if board["batch_size"]:
+        board["results"].clear()
+    board["windowed"] = True
+    board["batch_size"] = 0
+    board["seq"] = seq
+
+    if not board["bat_mask"] & (1 << bat):
+        pixels = np.frombuffer(data, np.uint8, offset=HEADER_SIZE)
+        board["img"][bat * PACKET_SIZE : (bat + 1) * PACKET_SIZE] = pixels
+        board["bat_mask"] |= 1 << bat
+    transmit(board, [board["seq"], bat, board["bat_mask"]], addr)
+
+    return board["bat_mask"] == ALL_BATS
+
+
+def run_inf(board, img):
+    # classify an image, taking at least the configured latency like cop_run does
+    t0 = time.perf_counter()
+    output = simulator.run_plan(board["plan"], img.reshape(IMG_SHAPE), board["arena"])
+    res = int(simulator.predict(output))
+
+    remaining = board["latency"] - (time.perf_counter() - t0)
+    if remaining > 0:
+        time.sleep(remaining)
+
+    return res
+
+
+def start_inf(board, addr):
+    # like cop_start: the result is computed right away, but only sent once the configured latency has passed
+    t0 = time.perf_counter()
+    output = simulator.run_plan(board["plan"], board["img"].reshape(IMG_SHAPE), board["arena"])
+    board["busy"] = {
+        "seq": board["seq"],
+        "windowed": board["windowed"],
+        "res": int(simulator.predict(output)),
+        "due": t0 + board["latency"],
+        "addr": addr,
+    }
+
+
+def finish_inf(board, verbose=False):
+    busy = board["busy"]
+    board["busy"] = None
+    if busy["windowed"]:
+        board["results"].append((busy["seq"], busy["res"]))
+    board["count"] += 1
+    transmit(board, [busy["seq"], busy["res"]], busy["addr"])
+
+    if verbose:
+        print(f"SEQ {busy['seq']}: {busy['res']}")
+
+
+def wait_inf(board, verbose=False):
+    if board["busy"] is not None:
+        remaining = board["busy"]["due"] - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+        finish_inf(board, verbose)
+
+
+def serve(board, verbose=False):
+    # main loop of hardware_test.c: receive an image, start classifying it and send the result once it is done,
+    # receiving the next image in the meantime. Packets are answered to their sender, so clients on any port work
+    sock = board["sock"]
+
+    while True:
+        board["bat"] = 0
+        board["bat_mask"] = 0
+        done = False
+
+        while not done:
+            timeout = IDLE_TIMEOUT
+            if board["busy"] is not None:
+                timeout = board["busy"]["due"] - time.perf_counter()
+                if timeout <= 0:
+                    finish_inf(board, verbose)
+                    continue
+
+            sock.settimeout(min(timeout, IDLE_TIMEOUT))
+            try:
+                data, addr = sock.recvfrom(2 * PACKET_SIZE)
+            except socket.timeout:
+                flush(board)
+                continue
+
+            if board["rng"].random() < board["loss"]:
+                continue
+            done = receive_chunk(board, data, addr)
+
+        if not board["windowed"]:
+            board["seq"] = (board["seq"] + 1) % NUM_SEQ
+
+        # one image at a time, the previous one has to finish first
+        wait_inf(board, verbose)
+
+        if board["batch_size"]:
+            for i in range(board["batch_size"]):
+                board["batch_res"][i] = run_inf(board, board["batch_px"][i])
+            transmit(board, batch_result(board), addr)
+            board["results"].append((board["seq"], None))
+            board["count"] += board["batch_size"]
+            if verbose:
+                print(f"SEQ {board['seq']}: {board['batch_size']} images")
+            continue
+
+        start_inf(board, addr)
+        # in stop-and-wait mode, the host sends the next image only after the result
+        if not board["windowed"]:
+            wait_inf(board, verbose)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    import tensorflow as tf
+
+    interpreter = tf.lite.Interpreter(model_path=args["model"])
+    interpreter.allocate_tensors()
+    plan = simulator.build_plan(interpreter)
+
+    cycles = perf_model.estimate(perf_model.plan_to_config(plan))["total"]
+    latency = args["latency"]
+    if latency < 0:
+        latency = cycles / perf_model.CLOCK
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((args["ip"], args["port"]))
+    board = init_board(plan, sock, latency, args["loss"], args["reorder"], args["seed"], round(cycles))
+
+    print(f"fake board on {args['ip']}:{args['port']}, {1000 * latency:.2f} ms per inference")
+    serve(board, args["verbose"])
@@ -0,0 +1,106 @@
+import csv
+import json
+import math
+
+import numpy as np
+
+# log-bucketed latency histograms, one per phase of a request:
+#   queue    request to its first chunk, i.e. waiting for the board (async client only)
+#   service  first chunk, or the result of the image before it if later, to result, i.e. the time the board
+#            spends on the image alone (async client only)
+#   ack      send of a chunk to its ACK, for chunks sent once
+#   result   last ACK of an image to its result, i.e. the inference on the board and the rest of the one before it.
+#            For a batch, the ACK that completes it to its result
+#   retry    first resend of an image to its result, for images that needed one
+#   total    request to its result
+# Latencies are recorded in nanoseconds (time.perf_counter_ns). Every power of two is split into SUB_BUCKETS buckets,
+# so percentiles are exact to within 2^(1/SUB_BUCKETS), about 9%, from 1 ns to 2^MAX_EXP ns (18 minutes)
+
+SUB_BUCKETS = 8
+MAX_EXP = 40
+NUM_BUCKETS = MAX_EXP * SUB_BUCKETS
+PERCENTILES = [50, 90, 99, 99.9]
+PHASES = ["queue", "service", "ack", "result", "retry", "total"]
+
+
+def init_histogram():
+    return {"counts": np.zeros(NUM_BUCKETS, dtype=np.int64), "count": 0, "sum": 0, "min": None, "max": None}
+
+
+def init_phases(phases=PHASES):
+    return {phase: init_histogram() for phase in phases}
+
+
+def bucket(ns):
+    if ns < 1:
+        return 0
+    return min(int(math.log2(ns) * SUB_BUCKETS), NUM_BUCKETS - 1)
+
+
+def bucket_bounds(idx):
+    # lowest and highest latency in ns that fall into bucket idx
+    return 2 ** (idx / SUB_BUCKETS), 2 ** ((idx + 1) / SUB_BUCKETS)
+
+
+def record(hist, ns):
+    hist["counts"][bucket(ns)] += 1
+    hist["count"] += 1
+    hist["sum"] += ns
+    hist["min"] = ns if hist["min"] is None else min(hist["min"], ns)
+    hist["max"] = ns if hist["max"] is None else max(hist["max"], ns)
+
+
+def percentile(hist, q):
+    # latency in ns below which q percent of the recorded ones are. Reported as the upper bound of the bucket, but
+    # never above the largest latency recorded
+    if hist["count"] == 0:
+        return None
+
+    rank = max(math.ceil(q / 100 * hist["count"]), 1)
+    idx = int(np.searchsorted(np.cumsum(hist["counts"]), rank))
+    return min(bucket_bounds(idx)[1], hist["max"])
+
+
+def summary(hist):
+    # count, mean, min, max and PERCENTILES of a histogram, in ns
+    res = {"count": hist["count"], "mean": hist["sum"] / hist["count"] if hist["count"] else None}
+    res["min"], res["max"] = hist["min"], hist["max"]
+    for q in PERCENTILES:
+        res[f"p{q:g}"] = percentile(hist, q)
+    return res
+
+
+def print_summary(phases):
+    print(f"{'phase':8}{'count':>8}" + "".join(f"{f'p{q:g}':>10}" for q in PERCENTILES) + f"{'max':>10}  (ms)")
+
+    for phase, hist in phases.items():
+        s = summary(hist)
+        if s["count"] == 0:
+            continue
+        values = [s[f"p{q:g}"] for q in PERCENTILES] + [s["max"]]
+        print(f"{phase:8}{s['count']:>8}" + "".join(f"{v / 1e6:>10.3f}" for v in values))
+
+
+def export_json(phases, path):
+    # summary and non-empty buckets of every phase
+    res = {}
+    for phase, hist in phases.items():
+        nonzero = np.flatnonzero(hist["counts"])
+        res[phase] = {
+            "summary": summary(hist),
+            "buckets": [[*bucket_bounds(int(i)), int(hist["counts"][i])] for i in nonzero],
+        }
+
+    with open(path, "w") as f:
+        json.dump(res, f, indent=2)
+
+
+def export_csv(phases, path):
+    # one row per non-empty bucket: phase, bounds in ns and count
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["phase", "lower_ns", "upper_ns", "count"])
+        for phase, hist in phases.items():
+            for i in np.flatnonzero(hist["counts"]):
+                lower, upper = bucket_bounds(int(i))
+                writer.writerow([phase, f"{lower:.0f}", f"{upper:.0f}", int(hist["counts"][i])])
@@ -0,0 +1,147 @@
+import numpy as np
+
+# UDP protocol between the host and the board, see hardware_test/hardware_test.c.
+# An image is sent in NUM_BAT chunks of PACKET_SIZE pixels. In windowed mode, every chunk starts with a {SEQ, BAT}
+# header and is acknowledged with {SEQ, BAT, MASK}, where MASK has one bit set per chunk received so far. The result
+# of an image is sent as {SEQ, class}. The board receives the next windowed image while it classifies the previous one
+# and keeps the last NUM_RES results, to send them again when the host resends a chunk of a finished image.
+# In batch mode, the host declares K images in the header of every chunk, {SEQ, K, IMG, BAT}, and chunks are
+# acknowledged with {SEQ, IMG, BAT, MASK} for the mask of image IMG. The board classifies all K images back to back
+# and answers with a single {SEQ, BATCH_RES, K, classes[K], cycles[K]}, where the cycle counts are 32 bit big endian
+# and only present if the host set BATCH_CYCLES in K.
+# Results are kept by SEQ only, and every host starts counting SEQs anew. A host therefore starts a session with a
+# single {RESET} byte, which the board answers with {RESET} once it dropped the results it kept and any inference
+# still running, so that no result of an earlier run answers a request of this one
+
+CLASSES = ["AIRPLANE", "AUTOMOBILE", "BIRD", "CAT", "DEER", "DOG", "FROG", "HORSE", "SHIP", "TRUCK"]
+TARGET_IP = "192.168.24.50"
+HOST_IP = "192.168.24.45"
+PORT = 5005
+PACKET_SIZE = 1024
+NUM_BAT = 3
+# timeouts before a request fails. With exponential backoff, this bounds a request to about RTO * 2^MAX_TRIES
+MAX_TRIES = 6
+# seconds to wait for an answer before resending, until the first round trip is measured
+TIMEOUT = 1
+# seconds a request goes without any answer on top of a usual round trip before it fails, even if MAX_TRIES allows
+# more timeouts. A board that does not answer at all then costs about as long as with the 3 fixed timeouts of old,
+# however far the timeout backed off
+MAX_SILENCE = 3 * TIMEOUT
+
+HEADER_SIZE = 2
+ACK_SIZE = 2
+SACK_SIZE = 3
+RES_SIZE = 2
+ALL_BATS = (1 << NUM_BAT) - 1
+# SEQ is a single byte
+NUM_SEQ = 256
+# results kept by the board, which limits the images a host can have on it at once
+NUM_RES = 2
+RESET = 0xFF
+RESET_SIZE = 1
+
+BATCH_HEADER_SIZE = 4
+BATCH_SACK_SIZE = 4
+BATCH_RES = 0xFF
+BATCH_CYCLES = 0x80
+# images per batch, limited by the memory of the board
+MAX_BATCH_IMGS = 64
+# chunks of a batch in flight at once. As many as a single image in windowed mode, so the board sees no larger bursts
+BATCH_WINDOW = NUM_BAT
+
+# retransmission timeout estimation after Jacobson/Karels (RFC 6298): smoothing gains of the round trip time and its
+# variation, weight of the variation, and bounds of the timeout in seconds. The upper bound also caps the backoff
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+RTT_K = 4
+RTO_MIN = 0.01
+RTO_MAX = 2 * TIMEOUT
+# clock granularity in seconds
+RTO_G = 0.001
+
+
+class InferenceError(Exception):
+    pass
+
+
+class InferenceTimeout(InferenceError, TimeoutError):
+    pass
+
+
+def make_chunks(img, seq):
+    # all chunks of an image, each prefixed with the {SEQ, BAT} header
+    pixels = img.flatten().tobytes()
+    return [bytes([seq, bat]) + pixels[bat * PACKET_SIZE : (bat + 1) * PACKET_SIZE] for bat in range(NUM_BAT)]
+
+
+def missing(mask):
+    # chunks not set in an ACK mask
+    return [bat for bat in range(NUM_BAT) if not mask & (1 << bat)]
+
+
+def batch_headers(seq, k, idx, bats, cycles=False):
+    # {SEQ, K, IMG, BAT} headers of the chunks bats[i] of images idx[i] of a batch of k, shape (len(bats), 4)
+    headers = np.empty((len(bats), BATCH_HEADER_SIZE), dtype=np.uint8)
+    headers[:, 0] = seq
+    headers[:, 1] = k | (BATCH_CYCLES if cycles else 0)
+    headers[:, 2] = idx
+    headers[:, 3] = bats
+    return headers
+
+
+def parse_batch_result(data):
+    # classes and cycle counts (None if not requested) of a batch result
+    k = data[2] & ~BATCH_CYCLES
+    classes = np.frombuffer(data, dtype=np.uint8, count=k, offset=3).astype(np.int64)
+
+    if not data[2] & BATCH_CYCLES:
+        return classes, None
+    return classes, np.frombuffer(data, dtype=">u4", count=k, offset=3 + k).astype(np.int64)
+
+
+def init_rto():
+    # estimator state of a single kind of round trip, e.g. chunk to ACK
+    return {"srtt": None, "rttvar": None, "rto": TIMEOUT, "samples": 0}
+
+
+def rto_sample(est, rtt):
+    # update the estimator with a round trip time in seconds. By Karn's rule, callers only pass round trips that
+    # involved no retransmission, since the answer could belong to either transmission otherwise
+    if est["srtt"] is None:
+        est["srtt"] = rtt
+        est["rttvar"] = rtt / 2
+    else:
+        est["rttvar"] = (1 - RTT_BETA) * est["rttvar"] + RTT_BETA * abs(est["srtt"] - rtt)
+        est["srtt"] = (1 - RTT_ALPHA) * est["srtt"] + RTT_ALPHA * rtt
+
+    est["rto"] = min(max(est["srtt"] + max(RTO_G, RTT_K * est["rttvar"]), RTO_MIN), RTO_MAX)
+    est["samples"] += 1
+
+
+def rto_backoff(est):
+    # double the timeout after it expired. The next valid sample resets it
+    est["rto"] = min(2 * est["rto"], RTO_MAX)
+
+
+def scale_rto(est, k):
+    # estimator of k round trips of the kind est times, one after another, e.g. of the inferences of a batch. Once
+    # sampled, the timeout may exceed RTO_MAX and only next_timeout cuts it, at the silence limit
+    if est["srtt"] is None:
+        return dict(est, rto=min(k * est["rto"], RTO_MAX))
+    return dict(est, srtt=k * est["srtt"], rttvar=k * est["rttvar"], rto=k * est["rto"])
+
+
+def silence_limit(est):
+    # seconds without an answer after which a request waiting for a round trip of this kind fails
+    return MAX_SILENCE + (est["srtt"] or 0)
+
+
+def next_timeout(est, silent):
+    # seconds to wait for the next answer after silent seconds without one: the retry timeout, cut at the silence
+    # limit. Never below the clock granularity, so a socket timeout of 0 never makes it non-blocking
+    return max(min(est["rto"], silence_limit(est) - silent), RTO_G)
+
+
+def init_stats():
+    # counters of a client
+    return {"requests": 0, "retries": 0, "timeouts": 0, "failed": 0}
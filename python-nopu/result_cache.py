@@ -0,0 +1,133 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from transport import flat_pixels
+
+# cache of classification results in front of an accelerator client, e.g.
+#   cache = ResultCache(path="results.npz")
+#   res = cache.lookup(img, lambda: inf(img))
+# Entries are keyed by a hash of the image and of the parameters the accelerator runs with, i.e. parameters.h as
+# written by gen_c_arrs.py. When that file changes, all entries are dropped
+
+# entries kept before the least recently used one is evicted
+CAPACITY = 1 << 16
+PARAMS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../model_parameters/parameters.h")
+KEY_SIZE = 16
+
+
+def params_version(path):
+    # hash of a parameter file, or empty if it does not exist
+    if not os.path.exists(path):
+        return b""
+
+    h = hashlib.blake2b(digest_size=KEY_SIZE)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.digest()
+
+
+class ResultCache:
+    def __init__(self, capacity=CAPACITY, path=None, params=PARAMS_PATH):
+        self.capacity = capacity
+        self.path = path
+        self.params = params
+        # key -> class, least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.params_stat = None
+        self.version = b""
+        self.check_version()
+
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def check_version(self):
+        # drop all entries if the parameter file changed. Hashes the file only if its size or mtime differ
+        try:
+            st = os.stat(self.params)
+            params_stat = (st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            params_stat = None
+
+        if params_stat == self.params_stat:
+            return
+        self.params_stat = params_stat
+
+        version = params_version(self.params)
+        if version != self.version:
+            self.version = version
+            self.entries.clear()
+
+    def key(self, img):
+        return hashlib.blake2b(flat_pixels(img), digest_size=KEY_SIZE, key=self.version).digest()
+
+    def get(self, img):
+        # cached class of an image, or None
+        self.check_version()
+        key = self.key(img)
+        res = self.entries.get(key)
+
+        if res is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return res
+
+    def put(self, img, res):
+        self.check_version()
+        key = self.key(img)
+        self.entries[key] = int(res)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def lookup(self, img, infer):
+        # class of an image from the cache, or from infer() on a miss. Failed inferences raise and are not cached
+        res = self.get(img)
+        if res is None:
+            res = infer()
+            self.put(img, res)
+        return res
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def save(self, path=None):
+        # write the entries in LRU order, together with the parameter version they belong to
+        path = path or self.path
+        keys = np.frombuffer(b"".join(self.entries), dtype=np.uint8).reshape(-1, KEY_SIZE)
+        classes = np.fromiter(self.entries.values(), dtype=np.int16, count=len(self.entries))
+
+        with open(path, "wb") as f:
+            np.savez(f, keys=keys, classes=classes, version=np.frombuffer(self.version, dtype=np.uint8))
+
+    def load(self, path):
+        # add the entries of a saved cache, unless they belong to other parameters
+        with np.load(path) as f:
+            if f["version"].tobytes() != self.version:
+                return
+            keys, classes = f["keys"], f["classes"]
+
+        for key, res in zip(keys, classes):
+            self.entries[key.tobytes()] = int(res)
+            self.entries.move_to_end(key.tobytes())
+
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
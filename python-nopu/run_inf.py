@@ -1,15 +1,52 @@
+import argparse
 import socket
-import tensorflow as tf
 import numpy as np
 import time
 import sys
+import os
 import cv2
 
-def load_cifar10():
-    cifar10 = tf.keras.datasets.cifar10
-    (train_images, train_labels), (test_images, test_labels) = cifar10.load_data()
-    
-    return (train_images, train_labels), (test_images, test_labels)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../model_prep/src"))
+import bulk
+import data_loader
+from latency import export_csv, export_json, init_phases, print_summary, record
+from protocol import (
+    ACK_SIZE,
+    ALL_BATS,
+    BATCH_RES,
+    BATCH_SACK_SIZE,
+    BATCH_WINDOW,
+    CLASSES,
+    HOST_IP,
+    InferenceError,
+    InferenceTimeout,
+    MAX_BATCH_IMGS,
+    MAX_SILENCE,
+    MAX_TRIES,
+    NUM_BAT,
+    NUM_SEQ,
+    PACKET_SIZE,
+    PORT,
+    RES_SIZE,
+    RESET,
+    RESET_SIZE,
+    RTO_MAX,
+    SACK_SIZE,
+    TARGET_IP,
+    TIMEOUT,
+    batch_headers,
+    init_rto,
+    init_stats,
+    missing,
+    next_timeout,
+    parse_batch_result,
+    rto_backoff,
+    rto_sample,
+    scale_rto,
+    silence_limit,
+)
+from result_cache import CAPACITY, ResultCache
+from transport import Transport, flat_pixels
 
 def save_example_images():
     for i in range(10):
@@ -18,9 +55,19 @@ def save_example_images():
 def send(ip, port, payload, s):
     s.sendto(payload, (ip, port))
 
-def wait_for_ack(s):
-    data, _ = s.recvfrom(1024)
-    return data[0], data[1]
+def wait_for_ack(s, chunk):
+    # the ACK of a stop-and-wait chunk carries the number of chunks the board has, so chunk + 1. Stop-and-wait chunks
+    # have no header, so the SEQ is the board's and cannot be checked. Anything else (a late ACK of the chunk before,
+    # a reset answer, a result) is dropped until the socket timeout runs out, which raises socket.timeout
+    deadline = time.perf_counter() + s.gettimeout()
+    while True:
+        data, _ = s.recvfrom(1024)
+        if len(data) == ACK_SIZE and data[1] == chunk + 1:
+            return data[0], data[1]
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            raise socket.timeout
+        s.settimeout(remaining)
 
 def receive(s):    
     try:
@@ -30,67 +77,465 @@ def receive(s):
         return None
 
 
-CLASSES = ["AIRPLANE", "AUTOMOBILE", "BIRD", "CAT", "DEER", "DOG", "FROG", "HORSE", "SHIP", "TRUCK"]
 SEQ = 0
 BAT = 0
-NUM_BAT = 3
-MAX_TRIES = 3
-(_, _), (test_images, test_labels) = load_cifar10()
-TARGET_IP = "192.168.24.50"
-HOST_IP = "192.168.24.45"
-PORT = 5005
-PACKET_SIZE = 1024
+test_images, test_labels = data_loader.load_cached("cifar")
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind((HOST_IP, PORT))
-sock.settimeout(1)
+sock.settimeout(TIMEOUT)
+transport = None
+# round trip estimators for chunk to ACK and for last ACK to result, which includes the inference on the board, of
+# single images and of batches. The one of batches is per image, so that batches of any size share it
+rto = {"ack": init_rto(), "result": init_rto(), "batch": init_rto()}
+stats = init_stats()
+latency = init_phases()
+cache = None
 
 def send_img_chunk(img, chunk):
-    send(TARGET_IP, PORT, img.flatten()[chunk*PACKET_SIZE:(chunk+1)*PACKET_SIZE].tobytes(), sock)
+    send(TARGET_IP, PORT, flat_pixels(img)[chunk*PACKET_SIZE:(chunk+1)*PACKET_SIZE], sock)
     try:
-        res_SEQ, res_BAT = wait_for_ack(sock)
+        res_SEQ, res_BAT = wait_for_ack(sock, chunk)
         # print(f"ACK SEQ {int(res_SEQ)} BAT {int(res_BAT)}")
         return True
-    except Exception:
+    except socket.timeout:
         return False
 
-def inf(img):
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image", type=int, nargs="?", default=-1, help="index of a single test image to classify")
+    parser.add_argument(
+        "--stop_and_wait",
+        action="store_true",
+        help="send chunks one at a time and wait for an ACK after each one (legacy protocol)",
+    )
+    parser.add_argument("--target", default=TARGET_IP, help="address of the board, e.g. of fake_board.py")
+    parser.add_argument("--host", default=HOST_IP, help="local address to bind to")
+    parser.add_argument("-n", "--num_images", type=int, default=10, help="number of test images to classify")
+    parser.add_argument(
+        "--no_batching",
+        action="store_true",
+        help="send packets one at a time even where sendmmsg/recvmmsg are available",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch_size",
+        type=int,
+        default=0,
+        help=f"send images in batches of up to {MAX_BATCH_IMGS} with a single result each",
+    )
+    parser.add_argument("--cycles", action="store_true", help="in batch mode, report the cycles of every inference")
+    parser.add_argument(
+        "-i",
+        "--input",
+        help="classify all images of a .npy file, a directory of images or '-' for raw images on stdin",
+    )
+    parser.add_argument("-o", "--output", default="results.csv", help="with --input: .csv file or Parquet directory")
+    parser.add_argument("--resume", action="store_true", help="with --input: continue after the last checkpoint")
+    parser.add_argument("--latency_json", help="write the latency histograms of all phases to this JSON file")
+    parser.add_argument("--latency_csv", help="write the latency histograms of all phases to this CSV file")
+    parser.add_argument("--cache", action="store_true", help="answer repeated images from a result cache")
+    parser.add_argument("--cache_size", type=int, default=CAPACITY, help="images kept in the result cache")
+    parser.add_argument("--cache_file", help="file to load the result cache from and save it to, implies --cache")
+
+    args = vars(parser.parse_args())
+    if not 0 <= args["batch_size"] <= MAX_BATCH_IMGS:
+        parser.error(f"--batch_size must be between 0 and {MAX_BATCH_IMGS}")
+
+    return args
+
+def reset_board():
+    # start a session, see protocol.py, so that results the board kept from an earlier run do not answer the first
+    # requests of this one. Raises InferenceTimeout if the board does not answer
+    tries = round(MAX_SILENCE / TIMEOUT)
+    for _ in range(tries):
+        sock.sendto(bytes([RESET]), (TARGET_IP, PORT))
+        deadline = time.perf_counter() + TIMEOUT
+
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            if any(len(data) == RESET_SIZE for data in transport.receive(remaining)):
+                return
+        stats["timeouts"] += 1
+
+    raise InferenceTimeout(f"no answer to reset from {TARGET_IP} after {tries} tries")
+
+def send_missing(pixels, mask):
+    transport.send_chunks(pixels, missing(mask), SEQ)
+
+def resend(pixels, bats, t_chunk):
+    # resend chunks and note when. Returns the time in ns
+    now = time.perf_counter_ns()
+    transport.send_chunks(pixels, bats, SEQ)
+    for bat in bats:
+        t_chunk[bat] = now
+    stats["retries"] += len(bats)
+    return now
+
+def inf_windowed(img):
+    # send all chunks back-to-back and collect selective ACKs. The ACK of the last chunk acts as NACK for any
+    # chunk missing in its mask, which is resent right away. On a timeout, everything not acknowledged yet is
+    # resent. With all chunks acknowledged, any chunk makes the board repeat a lost result. Timeouts follow the
+    # measured round trips and back off exponentially; raises InferenceTimeout after MAX_TRIES of them, or once the
+    # board was silent for longer than silence_limit
+    global SEQ
+    SEQ = (SEQ + 1) % NUM_SEQ
+    pixels = flat_pixels(img)
+    mask = 0
+    err_count = 0
+    stats["requests"] += 1
+
+    t_start = time.perf_counter_ns()
+    send_missing(pixels, mask)
+    # last send of every chunk, chunks sent more than once and ACKed so far, first resend and completion of the mask.
+    # By Karn's rule, round trips involving a resend are not measured
+    t_chunk = [t_start] * NUM_BAT
+    resent = 0
+    acked = 0
+    t_resent = None
+    t_acked = None
+    result_resent = False
+    # last answer to this image
+    t_heard = t_start
+
+    while True:
+        est = rto["ack"] if mask != ALL_BATS else rto["result"]
+        packets = transport.receive(next_timeout(est, (time.perf_counter_ns() - t_heard) / 1e9))
+
+        if not packets:
+            err_count += 1
+            stats["timeouts"] += 1
+            rto_backoff(est)
+            if err_count >= MAX_TRIES or (time.perf_counter_ns() - t_heard) / 1e9 >= silence_limit(est):
+                stats["failed"] += 1
+                raise InferenceTimeout(f"no response to SEQ {SEQ} after {err_count} timeouts")
+
+            bats = [NUM_BAT - 1] if mask == ALL_BATS else missing(mask)
+            result_resent = mask == ALL_BATS
+            t = resend(pixels, bats, t_chunk)
+            t_resent = t_resent or t
+            resent |= sum(1 << bat for bat in bats)
+            continue
+
+        t_recv = t_heard = time.perf_counter_ns()
+        for data in packets:
+            # packets of earlier images are stale
+            if len(data) == 0 or data[0] != SEQ:
+                continue
+
+            if len(data) == SACK_SIZE:
+                bat = data[1]
+                if not (resent | acked) & (1 << bat):
+                    record(latency["ack"], t_recv - t_chunk[bat])
+                    rto_sample(rto["ack"], (t_recv - t_chunk[bat]) / 1e9)
+                acked |= 1 << bat
+                if mask != ALL_BATS and mask | data[2] == ALL_BATS:
+                    t_acked = t_recv
+                mask |= data[2]
+                if bat == NUM_BAT - 1 and mask != ALL_BATS:
+                    bats = missing(mask)
+                    t = resend(pixels, bats, t_chunk)
+                    t_resent = t_resent or t
+                    resent |= sum(1 << b for b in bats)
+            elif len(data) == RES_SIZE:
+                if mask == ALL_BATS:
+                    record(latency["result"], t_recv - t_acked)
+                    if not result_resent:
+                        rto_sample(rto["result"], (t_recv - t_acked) / 1e9)
+                if t_resent:
+                    record(latency["retry"], t_recv - t_resent)
+                record(latency["total"], t_recv - t_start)
+                return int(data[1])
+
+def inf(img, stop_and_wait=False):
+    if not stop_and_wait:
+        return inf_windowed(img)
+
+    stats["requests"] += 1
+    t_start = time.perf_counter_ns()
+    t_resent = None
+
     for i in range(NUM_BAT):
         err_count = 0
         success = False
-        while (not success and err_count < MAX_TRIES):
+        t_heard = time.perf_counter_ns()
+        while not success:
+            sock.settimeout(next_timeout(rto["ack"], (time.perf_counter_ns() - t_heard) / 1e9))
+            t_sent = time.perf_counter_ns()
             success = send_img_chunk(img, i)
-            err_count += 1
 
-        if not success:
-            print("TIMEOUT")
-            sys.exit(0)
+            if success:
+                if not err_count:
+                    t_ack = time.perf_counter_ns() - t_sent
+                    record(latency["ack"], t_ack)
+                    rto_sample(rto["ack"], t_ack / 1e9)
+                continue
 
+            err_count += 1
+            stats["timeouts"] += 1
+            rto_backoff(rto["ack"])
+            if err_count >= MAX_TRIES or (time.perf_counter_ns() - t_heard) / 1e9 >= silence_limit(rto["ack"]):
+                stats["failed"] += 1
+                raise InferenceTimeout(f"no ACK for chunk {i} after {err_count} timeouts")
+            t_resent = t_resent or time.perf_counter_ns()
+            stats["retries"] += 1
+
+    # the board cannot repeat a result in this protocol, so wait as long as a request may take
+    sock.settimeout(RTO_MAX)
+    t_acked = time.perf_counter_ns()
     res_data = receive(sock)
+    # a late reset answer is no result
+    while res_data is not None and len(res_data) != RES_SIZE:
+        sock.settimeout(max(RTO_MAX - (time.perf_counter_ns() - t_acked) / 1e9, 1e-3))
+        res_data = receive(sock)
 
-    if res_data:
-        res_SEQ, res_CLASS = res_data[0], res_data[1]
-        return int(res_CLASS)
-    else:
-        print("Accelerator did not respond")
-        return -1
+    if not res_data:
+        stats["timeouts"] += 1
+        stats["failed"] += 1
+        raise InferenceTimeout("Accelerator did not respond")
+
+    t_res = time.perf_counter_ns()
+    record(latency["result"], t_res - t_acked)
+    rto_sample(rto["result"], (t_res - t_acked) / 1e9)
+    if t_resent:
+        record(latency["retry"], t_res - t_resent)
+    record(latency["total"], t_res - t_start)
+    res_SEQ, res_CLASS = res_data[0], res_data[1]
+    return int(res_CLASS)
+
+def send_batch(pixels, headers, chunks, t_chunk):
+    # send chunks of a batch by their index (IMG * NUM_BAT + BAT) and note when. Returns the time in ns
+    now = time.perf_counter_ns()
+    transport.send_chunks(pixels, headers[chunks, 3], idx=headers[chunks, 2], headers=headers[chunks])
+    t_chunk[chunks] = now
+    return now
+
+def inf_batch(imgs, cycles=False):
+    # classify up to MAX_BATCH_IMGS images at once. The chunks of all images are streamed with up to BATCH_WINDOW of
+    # them unacknowledged at a time, so that the board sees no larger bursts than in windowed mode. A chunk is
+    # resent as soon as a chunk sent after it is acknowledged, and on timeouts. Fails after MAX_TRIES timeouts
+    # without progress, or once the board was silent for longer than silence_limit. The board answers with the
+    # classes of all images in a single packet. Returns the classes and the cycles of every inference if requested,
+    # else None
+    global SEQ
+    k = len(imgs)
+    if not 0 < k <= MAX_BATCH_IMGS:
+        raise ValueError(f"batches hold 1 to {MAX_BATCH_IMGS} images")
+
+    SEQ = (SEQ + 1) % NUM_SEQ
+    pixels = np.ascontiguousarray(imgs, dtype=np.uint8).reshape(k, -1)
+    chunks = np.arange(k * NUM_BAT)
+    headers = batch_headers(SEQ, k, chunks // NUM_BAT, chunks % NUM_BAT, cycles)
+    err_count = 0
+    stats["requests"] += 1
+
+    # last send of every chunk (0 if not sent yet), chunks sent more than once and ACKed so far, first resend and
+    # ACK of the last chunk missing
+    t_chunk = np.zeros(len(chunks), dtype=np.int64)
+    resent = np.zeros(len(chunks), dtype=bool)
+    acked = np.zeros(len(chunks), dtype=bool)
+    t_resent = None
+    t_acked = None
+    result_resent = False
+
+    t_start = t_heard = send_batch(pixels, headers, chunks[:BATCH_WINDOW], t_chunk)
+    sent = min(BATCH_WINDOW, len(chunks))
+
+    while True:
+        est = rto["ack"] if t_acked is None else scale_rto(rto["batch"], k)
+        packets = transport.receive(next_timeout(est, (time.perf_counter_ns() - t_heard) / 1e9))
+
+        if not packets:
+            err_count += 1
+            stats["timeouts"] += 1
+            rto_backoff(rto["ack"] if t_acked is None else rto["batch"])
+            if err_count >= MAX_TRIES or (time.perf_counter_ns() - t_heard) / 1e9 >= silence_limit(est):
+                stats["failed"] += 1
+                raise InferenceTimeout(f"no response to batch SEQ {SEQ} after {err_count} timeouts")
+
+            todo = chunks[-1:] if t_acked is not None else np.flatnonzero(~acked[:sent])
+            result_resent = t_acked is not None
+            t = send_batch(pixels, headers, todo, t_chunk)
+            t_resent = t_resent or t
+            resent[todo] = True
+            stats["retries"] += len(todo)
+            continue
+
+        t_recv = t_heard = time.perf_counter_ns()
+        for data in packets:
+            # packets of earlier images and of the other protocols are stale
+            if len(data) < BATCH_SACK_SIZE or data[0] != SEQ:
+                continue
+
+            if data[1] == BATCH_RES:
+                if t_acked is not None:
+                    record(latency["result"], t_recv - t_acked)
+                    if not result_resent:
+                        rto_sample(rto["batch"], (t_recv - t_acked) / k / 1e9)
+                if t_resent:
+                    record(latency["retry"], t_recv - t_resent)
+                record(latency["total"], t_recv - t_start)
+                return parse_batch_result(data)
+
+            chunk = data[1] * NUM_BAT + data[2]
+            if len(data) != BATCH_SACK_SIZE or data[1] >= k or data[2] >= NUM_BAT or acked[chunk]:
+                continue
+
+            if not resent[chunk]:
+                record(latency["ack"], t_recv - t_chunk[chunk])
+                rto_sample(rto["ack"], (t_recv - t_chunk[chunk]) / 1e9)
+            # the mask also acknowledges chunks whose ACKs were lost. Only timeouts in a row count towards MAX_TRIES
+            err_count = 0
+            acked[chunk] = True
+            acked[data[1] * NUM_BAT : (data[1] + 1) * NUM_BAT] |= (data[3] >> np.arange(NUM_BAT) & 1) == 1
+
+            # unacknowledged chunks sent before this one are lost
+            lost = np.flatnonzero(~acked[:sent] & (t_chunk[:sent] < t_chunk[chunk]))
+            if len(lost) > 0:
+                t = send_batch(pixels, headers, lost, t_chunk)
+                t_resent = t_resent or t
+                resent[lost] = True
+                stats["retries"] += len(lost)
+
+            # keep the window full
+            if sent < len(chunks):
+                more = chunks[sent : sent + BATCH_WINDOW - np.count_nonzero(~acked[:sent])]
+                send_batch(pixels, headers, more, t_chunk)
+                sent += len(more)
+
+            if t_acked is None and acked.all():
+                t_acked = t_recv
+                # until a batch was timed, the result of single images tells how long the board takes per image
+                if not rto["batch"]["samples"] and rto["result"]["samples"]:
+                    rto["batch"].update(rto["result"])
+
+def classify_batch(imgs, cycles=False):
+    # inf_batch through the result cache, if enabled. Only the images not in the cache are sent, cycles of the
+    # others are -1
+    if cache is None:
+        return inf_batch(imgs, cycles)
+
+    hits = [cache.get(img) for img in imgs]
+    classes = np.array([-1 if res is None else res for res in hits])
+    counts = np.full(len(imgs), -1) if cycles else None
+    todo = np.flatnonzero(classes < 0)
+
+    if len(todo) > 0:
+        res, res_cycles = inf_batch(imgs[todo], cycles)
+        classes[todo] = res
+        for i, c in zip(todo, res):
+            cache.put(imgs[i], c)
+        if cycles:
+            counts[todo] = res_cycles
+
+    return classes, counts
+
+def classify(img, stop_and_wait=False):
+    # inf through the result cache, if enabled
+    if cache is None:
+        return inf(img, stop_and_wait)
+    return cache.lookup(img, lambda: inf(img, stop_and_wait))
+
+def print_stats():
+    print(
+        f"{stats['requests']} requests, {stats['failed']} failed, "
+        f"{stats['timeouts']} timeouts, {stats['retries']} chunks resent"
+    )
+    for name, est in rto.items():
+        if est["samples"] > 0:
+            label = f"{name} round trip per image" if name == "batch" else f"{name} round trip"
+            print(
+                f"{label}: {1000 * est['srtt']:.2f} ms +- {1000 * est['rttvar']:.2f} ms, "
+                f"timeout {1000 * est['rto']:.2f} ms"
+            )
+    print_summary(latency)
+    if cache is not None:
+        c = cache.stats()
+        print(f"cache: {c['hits']} hits, {c['misses']} misses, {c['evictions']} evictions, {c['size']} entries")
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    args = parse_args()
+    TARGET_IP = args["target"]
+    sock.bind((args["host"], PORT))
+    transport = Transport(sock, (TARGET_IP, PORT), not args["no_batching"])
+    try:
+        reset_board()
+    except InferenceError as e:
+        sys.exit(str(e))
+    if args["cache"] or args["cache_file"]:
+        cache = ResultCache(args["cache_size"], args["cache_file"])
+
+    if args["input"]:
+        if args["batch_size"] > 0:
+            classify_block = lambda imgs: classify_batch(imgs, args["cycles"])
+        else:
+            classify_block = lambda imgs: ([classify(imgs[0], args["stop_and_wait"])], None)
+        done = bulk.run(
+            classify_block, args["input"], args["output"], max(args["batch_size"], 1), args["resume"], verbose=True
+        )
+        print(f"{done} images classified, results in {args['output']}")
+        print_stats()
+    elif args["image"] < 0 and args["batch_size"] > 0:
         times = []
         corrects = []
-        for i in range(10):
+        counts = []
+        for start in range(0, args["num_images"], args["batch_size"]):
+            stop = min(start + args["batch_size"], args["num_images"])
+            labels = test_labels[start:stop].reshape(-1).astype(int)
             t0 = time.time()
-            res = inf(test_images[i])
+            try:
+                res, cycles = classify_batch(test_images[start:stop], args["cycles"])
+            except InferenceError as e:
+                print(f"images {start} to {stop - 1}: {e}")
+                corrects.extend([False] * (stop - start))
+                continue
+            times.extend([(time.time() - t0) / (stop - start)] * (stop - start))
+            corrects.extend(res == labels)
+            if cycles is not None:
+                counts.extend(cycles[cycles >= 0])
+            for i in range(stop - start):
+                print(f"expected {CLASSES[labels[i]]}, got {CLASSES[res[i]]}")
+
+        print(f"accuracy: {sum(corrects) / len(corrects)}")
+        if times:
+            print(f"average time: {sum(times)/len(times)}")
+        if counts:
+            print(f"average cycles: {sum(counts) / len(counts):.0f}")
+        print_stats()
+    elif args["image"] < 0:
+        times = []
+        corrects = []
+        for i in range(args["num_images"]):
+            t0 = time.time()
+            try:
+                res = classify(test_images[i], args["stop_and_wait"])
+            except InferenceError as e:
+                # a failed image counts as wrong, the run goes on
+                print(f"image {i}: {e}")
+                corrects.append(False)
+                continue
             times.append(time.time() - t0)
             corrects.append(res == int(test_labels[i]))
             print(f"expected {CLASSES[int(test_labels[i])]}, got {CLASSES[res]}")
 
 
         print(f"accuracy: {sum(corrects) / len(corrects)}")
-        print(f"average time: {sum(times)/len(times)}")
+        if times:
+            print(f"average time: {sum(times)/len(times)}")
+        print_stats()
     else:
-        img_idx = int(sys.argv[1])
+        img_idx = args["image"]
         img = test_images[img_idx]
         label = int(test_labels[img_idx])
-        res = inf(img)
-        print(f"expected {CLASSES[label]}, got {CLASSES[res]}")
\ No newline at end of file
+        try:
+            res = classify(img, args["stop_and_wait"])
+            print(f"expected {CLASSES[label]}, got {CLASSES[res]}")
+        except InferenceError as e:
+            print(e)
+
+    if cache is not None and cache.path is not None:
+        cache.save()
+    if args["latency_json"]:
+        export_json(latency, args["latency_json"])
+    if args["latency_csv"]:
+        export_csv(latency, args["latency_csv"])
@@ -0,0 +1,240 @@
+import ctypes
+import ctypes.util
+import errno
+import select
+import socket
+import sys
+import time
+
+import numpy as np
+
+from protocol import BATCH_HEADER_SIZE, HEADER_SIZE, MAX_BATCH_IMGS, PACKET_SIZE
+
+# zero-copy packet transport. Pixels are sent straight from the caller's buffer (e.g. the memmap of the test set),
+# the {SEQ, BAT} headers from a preallocated array. On Linux, up to MAX_BATCH packets go to the kernel in a single
+# sendmmsg call, each one gathered from header and pixels, and responses are collected with recvmmsg. Elsewhere,
+# the transport falls back to one sendto per packet, copying the pixels into a preallocated packet buffer
+
+# packets per sendmmsg / recvmmsg call
+MAX_BATCH = 64
+# largest response of the board: the result of a full batch with cycle counts, padded
+RESPONSE_SIZE = 1 << (3 + 5 * MAX_BATCH_IMGS).bit_length()
+MSG_DONTWAIT = 0x40
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_ubyte * 2),
+        ("sin_addr", ctypes.c_ubyte * 4),
+        ("sin_zero", ctypes.c_ubyte * 8),
+    ]
+
+
+def load_mmsg():
+    # sendmmsg and recvmmsg from libc, or None where they are not available
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        calls = (libc.sendmmsg, libc.recvmmsg)
+    except (OSError, AttributeError):
+        return None
+
+    for call in calls:
+        call.restype = ctypes.c_int
+    calls[0].argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    calls[1].argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+
+    return calls
+
+
+MMSG = load_mmsg()
+
+
+def flat_pixels(img):
+    # flat uint8 view of an image, without copying it if it is contiguous already (e.g. a row of a memmap)
+    return np.ascontiguousarray(img, dtype=np.uint8).reshape(-1)
+
+
+class Transport:
+    def __init__(self, sock, target, batching=True):
+        self.sock = sock
+        self.target = target
+        # the batched path maps iovecs as pairs of pointer-sized words
+        words = ctypes.sizeof(iovec) == 2 * ctypes.sizeof(ctypes.c_void_p)
+        self.batching = batching and MMSG is not None and sock.family == socket.AF_INET and words
+        self.headers = np.zeros((MAX_BATCH, BATCH_HEADER_SIZE), dtype=np.uint8)
+        self.sent = 0
+        self.calls = 0
+
+        if self.batching:
+            self.init_mmsg()
+        else:
+            self.packet = np.zeros(BATCH_HEADER_SIZE + PACKET_SIZE, dtype=np.uint8)
+
+    def init_mmsg(self):
+        # message headers for up to MAX_BATCH packets of two iovecs each (header and pixels), all to the target,
+        # and as many receive buffers. The iovecs are also mapped as an array of (base, length) words, so they can
+        # be filled for a whole batch at once
+        self.addr = sockaddr_in(socket.AF_INET)
+        self.addr.sin_port[:] = self.target[1].to_bytes(2, "big")
+        self.addr.sin_addr[:] = socket.inet_aton(self.target[0])
+
+        self.send_iov = (iovec * (2 * MAX_BATCH))()
+        self.iov_words = np.frombuffer(self.send_iov, dtype=np.uintp).reshape(MAX_BATCH, 4)
+        self.send_msgs = (mmsghdr * MAX_BATCH)()
+        for i in range(MAX_BATCH):
+            hdr = self.send_msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.addr)
+            hdr.msg_namelen = ctypes.sizeof(self.addr)
+            hdr.msg_iov = ctypes.pointer(self.send_iov[2 * i])
+            hdr.msg_iovlen = 2
+        self.header_bases = self.headers.ctypes.data + BATCH_HEADER_SIZE * np.arange(MAX_BATCH, dtype=np.uintp)
+
+        self.recv_bufs = np.zeros((MAX_BATCH, RESPONSE_SIZE), dtype=np.uint8)
+        self.recv_iov = (iovec * MAX_BATCH)()
+        self.recv_msgs = (mmsghdr * MAX_BATCH)()
+        for i in range(MAX_BATCH):
+            self.recv_iov[i].iov_base = self.recv_bufs.ctypes.data + i * RESPONSE_SIZE
+            self.recv_iov[i].iov_len = RESPONSE_SIZE
+            self.recv_msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.recv_iov[i])
+            self.recv_msgs[i].msg_hdr.msg_iovlen = 1
+
+    def send_chunks(self, pixels, bats, seqs=None, idx=None, headers=None):
+        # send chunks of flat, C-contiguous uint8 images: chunk bats[i] of image pixels[idx[i]] with header
+        # {seqs[i], bats[i]}. Without idx, pixels is a single image. seqs is an array or a single SEQ for all chunks,
+        # or None to send plain stop-and-wait chunks without header. headers, an array of one row per chunk, replaces
+        # the {SEQ, BAT} headers, e.g. with batch headers
+        bats = np.asarray(bats, dtype=np.intp).reshape(-1)
+        if idx is None:
+            pixels = pixels.reshape(1, -1)
+            idx = np.zeros(len(bats), dtype=np.intp)
+        idx = np.asarray(idx, dtype=np.intp).reshape(-1)
+        if headers is None and seqs is not None:
+            headers = np.empty((len(bats), HEADER_SIZE), dtype=np.uint8)
+            headers[:, 0] = seqs
+            headers[:, 1] = bats
+
+        for start in range(0, len(bats), MAX_BATCH):
+            batch = slice(start, start + MAX_BATCH)
+            if self.batching:
+                self.send_mmsg(pixels, bats[batch], None if headers is None else headers[batch], idx[batch])
+            else:
+                self.send_each(pixels, bats[batch], None if headers is None else headers[batch], idx[batch])
+
+    def send_each(self, pixels, bats, headers, idx):
+        for i in range(len(bats)):
+            payload = pixels[idx[i], bats[i] * PACKET_SIZE : (bats[i] + 1) * PACKET_SIZE]
+
+            if headers is None:
+                self.sock.sendto(payload, self.target)
+            else:
+                size = headers.shape[1]
+                self.packet[:size] = headers[i]
+                self.packet[size : size + payload.nbytes] = payload
+                self.sock.sendto(self.packet[: size + payload.nbytes], self.target)
+
+        self.sent += len(bats)
+        self.calls += len(bats)
+
+    def send_mmsg(self, pixels, bats, headers, idx):
+        # point every packet at its header and into the pixels, then hand the batch to the kernel in as few calls
+        # as possible. pixels is referenced by the caller until the call returns
+        if pixels.strides[-1] != 1 or not pixels[0].flags.c_contiguous:
+            raise ValueError("images must be C-contiguous uint8")
+
+        n = len(bats)
+        offsets = bats * PACKET_SIZE
+        iov = self.iov_words[:n]
+
+        if headers is None:
+            iov[:, 1] = 0
+        else:
+            self.headers[:n, : headers.shape[1]] = headers
+            iov[:, 0] = self.header_bases[:n]
+            iov[:, 1] = headers.shape[1]
+
+        iov[:, 2] = pixels.ctypes.data + idx * pixels.strides[0] + offsets
+        iov[:, 3] = np.minimum(PACKET_SIZE, pixels.shape[1] - offsets)
+
+        done = 0
+        while done < n:
+            msgs = ctypes.cast(ctypes.byref(self.send_msgs, done * ctypes.sizeof(mmsghdr)), ctypes.POINTER(mmsghdr))
+            res = MMSG[0](self.sock.fileno(), msgs, n - done, 0)
+            self.calls += 1
+
+            if res < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    select.select([], [self.sock], [])
+                    continue
+                raise OSError(err, f"sendmmsg: {errno.errorcode.get(err, err)}")
+
+            done += res
+
+        self.sent += n
+
+    def receive(self, timeout):
+        # wait up to timeout seconds for responses and return all that arrived (a list of bytes objects). Returns an
+        # empty list on timeout only. A readable socket may still have nothing to read, e.g. after a datagram with a
+        # bad checksum was dropped, in which case the wait goes on for the rest of the timeout
+        deadline = time.perf_counter() + timeout
+
+        while True:
+            remaining = max(deadline - time.perf_counter(), 0)
+            readable, _, _ = select.select([self.sock], [], [], remaining)
+            if not readable:
+                return []
+
+            packets = self.receive_mmsg() if self.batching else self.drain()
+            if packets or remaining == 0:
+                return packets
+
+    def receive_mmsg(self):
+        # every response waiting in the socket, up to MAX_BATCH, without blocking
+        res = MMSG[1](self.sock.fileno(), self.recv_msgs, MAX_BATCH, MSG_DONTWAIT, None)
+        if res < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, f"recvmmsg: {errno.errorcode.get(err, err)}")
+
+        return [self.recv_bufs[i, : self.recv_msgs[i].msg_len].tobytes() for i in range(res)]
+
+    def drain(self):
+        # read every response waiting in the socket without blocking
+        packets = []
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+
+        try:
+            while len(packets) < MAX_BATCH:
+                packets.append(self.sock.recv(RESPONSE_SIZE))
+        except BlockingIOError:
+            pass
+        finally:
+            self.sock.settimeout(timeout)
+
+        return packets